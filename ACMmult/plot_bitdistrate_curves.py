@@ -243,7 +243,7 @@ def analyze_one_exp_dir(expdir,validdir,testdir,autobar=False,most_recent=False)
         model = ANALYZE.unpickle(os.path.join(best_model,'model.p'))
         print 'best model:',best_model,' ( dist =',best_dist,')'
         # return patternsize, codebook size, distortion errror, best saved model
-        return validdata.shape[1]/12, model._codebook.shape[0], best_dist, best_model
+        return validdata.shape[1]/12, model._nCodes, best_dist, best_model
     
     # test with test data
     model = ANALYZE.unpickle(os.path.join(best_model,'model.p'))
@@ -260,7 +260,7 @@ def analyze_one_exp_dir(expdir,validdir,testdir,autobar=False,most_recent=False)
     print 'best model:',best_model,' ( dist =',avg_dist,')'
 
     # return patternsize, codebook size, distortion errror, best saved model
-    return testdata.shape[1]/12, model._codebook.shape[0], avg_dist, best_model
+    return testdata.shape[1]/12, model._nCodes, avg_dist, best_model
 
 
 
@@ -22,6 +22,7 @@ import scipy as sp
 import scipy.spatial
 # ANN
 import scikits.ann as ann
+import search_backends as SB
 
 
 def euclidean_dist(a,b):
@@ -71,11 +72,16 @@ class Codebook:
         
     def _init_bounds(self):
         """
-        init bounds with real distances
+        init bounds with real distances, upper triangle,
+        computed by blocks of codes (see search_backends.py)
         """
-        for l in range(len(self)):
-            for c in range(l+1,len(self)):
-                self._codebounds[l,c] = self._dist(self[l],self[c])
+        dists = np.zeros([len(self),len(self)])
+        step = 256
+        for start in range(0,len(self),step):
+            dists[start:start+step] = SB.pairwise_distances(self._codebook[start:start+step],
+                                                            self._codebook)
+        upper = np.triu_indices(len(self),1)
+        self._codebounds[upper] = dists[upper]
 
     def _update_bounds(self,codeidx,newcode,oldcode):
         """
@@ -0,0 +1,138 @@
+"""
+Code to compare models in rate-distortion and encoding speed.
+Every model is applied to the same testset (loaded into memory),
+we report the bitrate (log2 of the number of codes), the average
+distortion and the number of patterns encoded per second.
+
+Models can be saved experiments (any kind, VQ, PQ, TSVQ, ...) or
+codebooks saved as matfiles, in which case we compare a flat Model
+and a tree (ModelTree) built on the same codewords.
+
+T. Bertin-Mahieux (2010) Columbia University
+tb2332@columbia.edu
+"""
+
+import os
+import sys
+import time
+import numpy as np
+
+import model as MODEL
+import trainer as TRAINER
+import oracle_matfiles as ORACLE
+import analyze_saved_model as ANALYZE
+from test_trained_models import print_write
+
+
+def evaluate_model(name,model,feats,output):
+    """
+    Encodes the features with the model, writes the results.
+    RETURN
+      bits (per pattern)
+      average dist
+      patterns per second
+    """
+    tstart = time.time()
+    best_code_per_p, dists = model.predicts(feats)
+    elapsed = max(time.time() - tstart,1e-6)
+    bits = np.log2(model._nCodes)
+    avg_dist = np.average(dists)
+    speed = feats.shape[0] / elapsed
+    print_write(name+': '+str(model._nCodes)+' codes, '+str(bits)+' bits, avg. dist: '+
+                str(avg_dist)+', '+str(int(speed))+' patterns/sec',output)
+    return bits,avg_dist,speed
+
+
+def models_to_compare(savedmodel,branching=2):
+    """
+    Returns a list of (name, model) for a saved experiment folder
+    or a codebook matfile.
+    """
+    if os.path.isdir(savedmodel):
+        model = ANALYZE.unpickle(os.path.join(savedmodel,'model.p'))
+        return [(savedmodel,model)]
+    codebook = TRAINER.load_codebook(savedmodel)
+    assert codebook != None,'Could not load codebook in: %s.'%savedmodel
+    flat = MODEL.Model(codebook,backend='brute')
+    tree = MODEL.ModelTree(codebook,branching=branching)
+    return [(savedmodel+' (VQ)',flat),(savedmodel+' (TSVQ)',tree)]
+
+
+def die_with_usage():
+    """
+    HELP MENU
+    """
+    print 'Compare models in rate-distortion and encoding speed.'
+    print 'Usage:'
+    print 'python compare_models.py [FLAGS] <matfilesdir> <output.txt> <exp> <model1> ...'
+    print 'PARAMS:'
+    print '  <matfilesdir>  test data'
+    print '  <output.txt>   '
+    print '  <exp>          saved experiment, gives the features params'
+    print '  <model1> ...   more saved experiments or codebooks (matfiles)'
+    print 'FLAGS:'
+    print '  -branching n   number of children per node for trees built'
+    print '                 from a codebook'
+    print '  -plot          plot distortion in function of bitrate'
+    print ''
+    print 'T. Bertin-Mahieux (2010) Columbia University'
+    print 'tb2332@columbia.edu'
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+
+    # help menu
+    if len(sys.argv) < 4:
+        die_with_usage()
+
+    # flags
+    branching = 2
+    doplot = False
+    while True:
+        if sys.argv[1] == '-branching':
+            branching = int(sys.argv[2])
+            sys.argv.pop(1)
+        elif sys.argv[1] == '-plot':
+            doplot = True
+        else:
+            break
+        sys.argv.pop(1)
+
+    # params
+    matfilesdir = os.path.abspath(sys.argv[1])
+    output = os.path.abspath(sys.argv[2])
+    savedmodels = [os.path.abspath(x) for x in sys.argv[3:]]
+    assert os.path.isdir(savedmodels[0]),'first model must be a saved experiment'
+
+    # init output
+    print_write('comparison launched on '+time.ctime(),output,mode='w')
+    print_write('matfiles dir = '+ matfilesdir,output)
+    print_write('output = '+output,output)
+
+    # load data into memory, with params of the first experiment
+    params = ANALYZE.unpickle(os.path.join(savedmodels[0],'params.p'))
+    oracle = ORACLE.OracleMatfiles(params,matfilesdir,oneFullIter=True)
+    data = [x for x in oracle]
+    data = filter(lambda x: x != None, data)
+    data = np.concatenate(data)
+    data = data[np.where(np.sum(data,axis=1)>0)]
+    print_write(str(data.shape[0])+' non-zero patterns loaded.',output)
+    if data.shape[0] == 0:
+        print_write('No patterns loaded, quit.',output)
+        sys.exit(0)
+
+    # evaluate every model
+    results = []
+    for savedmodel in savedmodels:
+        for name,model in models_to_compare(savedmodel,branching=branching):
+            results.append(evaluate_model(name,model,data,output))
+
+    # plot
+    if doplot:
+        import pylab as P
+        results = np.array(results)
+        P.plot(results[:,0],results[:,1],'o')
+        P.xlabel('bits per pattern')
+        P.ylabel('avg. dist')
+        P.show()
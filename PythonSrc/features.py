@@ -14,12 +14,13 @@ import glob
 import scipy as sp
 import scipy.io
 import scipy.signal
+import scipy.sparse
 import numpy as np
 
 
 def get_features(analysis_dict,pSize=8,usebars=2,keyInv=True,songKeyInv=False,
                  positive=True,do_resample=True,partialbar=0, offset=0,
-                 btchroma_barbts=None,model=None):
+                 btchroma_barbts=None,model=None,precision='float64'):
     """
     Main function, similar to those in demos.py for BostonHackDay
     Receives a dictionary containing:
@@ -44,6 +45,7 @@ def get_features(analysis_dict,pSize=8,usebars=2,keyInv=True,songKeyInv=False,
       do_resample        if True resample, otherwise pad with zeros or crop
       partialbar         cut bars into pieces of size partialbar
       btchroma_barbts    pair(btchroma,barbts) if info known (set dict to None)
+      precision          'float64' or 'float32', type of the features
 
     RETURN:
       feats              features, one pattern per row, or None if problem
@@ -85,57 +87,87 @@ def get_features(analysis_dict,pSize=8,usebars=2,keyInv=True,songKeyInv=False,
     if len(splits) < 2:
         return None
 
-    # allocate space for answer
+    # sizes of the answer
     nSubPieces = 1
     realSize = pSize # or partialb if partialbar > 0
     if partialbar > 0:
         assert pSize % partialbar == 0,'bad partialbar: does not divide pSize'
         realSize = partialbar
         nSubPieces = pSize / partialbar
-    feats = np.zeros([(len(splits)-1)*nSubPieces,12*realSize])
-
-    # iterate on patterns
-    splitidx = -1
-    for k in range(0,feats.shape[0],nSubPieces):
-        # pattern before resize and invariance
-        splitidx += 1
-        pattern = btchroma[:,splits[splitidx]:splits[splitidx+1]]
-        # resize by resampling on pad/crop
-        if do_resample:
-            patterns = [resample(pattern,pSize)]
-        else:
-            patterns = [pad_crop(pattern,pSize)]
-        # partialbar
-        if partialbar > 0:
-            nPatterns = len(patterns)
-            patterns = np.split(np.concatenate(patterns,axis=1),nPatterns*nSubPieces,axis=1)
-        # key invariance
-        if keyInv:
-            patterns = [keyinvariance(p) for p in patterns]
-        # add it to feats
-        feats[k:k+nSubPieces,:] = np.concatenate([p.reshape(1,realSize*12) for p in patterns],axis=0)
+
+    # resize patterns by resampling or pad/crop, patterns of the same
+    # length are done together with one matrix, see resize_matrix()
+    starts = np.asarray(splits[:-1],dtype='int')
+    lengths = np.asarray(np.diff(splits),dtype='int')
+    nPatterns = len(starts)
+    patterns = np.zeros([nPatterns,12,pSize])
+    for length in np.unique(lengths):
+        idxs = np.where(lengths == length)[0]
+        cols = starts[idxs][:,np.newaxis] + np.arange(length)
+        group = btchroma[:,cols].transpose(1,0,2).reshape(len(idxs)*12,length)
+        group = np.dot(group,resize_matrix(length,pSize,do_resample))
+        patterns[idxs] = group.reshape(len(idxs),12,pSize)
+    # partialbar, cut every pattern in nSubPieces
+    if partialbar > 0:
+        patterns = patterns.reshape(nPatterns,12,nSubPieces,realSize)
+        patterns = patterns.transpose(0,2,1,3).reshape(nPatterns*nSubPieces,12,realSize)
+    # key invariance
+    if keyInv:
+        patterns = keyinvariance_batch(patterns)
+    feats = np.asarray(patterns.reshape(nPatterns*nSubPieces,12*realSize),
+                       dtype=precision)
 
     # remove negative numbers
     if positive:
         feats[np.where(feats<0)] = 0
 
-    # offset (SLOW)
+    # offset
     if offset > 0:
-        assert offset < realSize,'offset too large! must be < to regular pattern length'
-        # reform features as one big matrix, 12 x something
-        feats = np.concatenate([c.reshape(12,realSize) for c in feats],axis=1)
-        # remove the offset, and the end
-        feats = feats[:,offset:-(realSize-offset)]
-        if feats.shape[1] == 0:
-            return None
-        # reform features, by splitting the big matrix, flattening, concatenating
-        nDivs = feats.shape[1] / realSize
-        feats = np.concatenate([c.flatten().reshape(1,12*realSize) for c in np.split(feats,nDivs,axis=1)],axis=0)
+        return apply_offset(feats,offset,realSize)
 
     # done, return features
     return feats
 
 
+def apply_offset(feats,offset,realSize):
+    """
+    Offset features (as get_features() returns them with offset=0):
+    new pattern k is the end of pattern k and the beginning of pattern
+    k+1, as if cut from all patterns put side by side.
+    Returns features, or None if there are not enough patterns.
+    """
+    assert offset < realSize,'offset too large! must be < to regular pattern length'
+    if offset == 0:
+        return feats
+    if feats.shape[0] < 2:
+        return None
+    patterns = feats.reshape(feats.shape[0],12,realSize)
+    feats = np.concatenate([patterns[:-1,:,offset:],patterns[1:,:,:offset]],axis=2)
+    return feats.reshape(feats.shape[0],12*realSize)
+
+
+def get_features_offsets(analysis_dict,offsets,pSize=8,usebars=2,keyInv=True,
+                         songKeyInv=False,positive=True,do_resample=True,
+                         partialbar=0,btchroma_barbts=None,
+                         precision='float64'):
+    """
+    Same as get_features() for a list of offsets, the patterns are
+    computed once and shifted for each offset.
+    Returns a list of features, one per offset (None if problem)
+    """
+    feats = get_features(analysis_dict,pSize=pSize,usebars=usebars,
+                         keyInv=keyInv,songKeyInv=songKeyInv,
+                         positive=positive,do_resample=do_resample,
+                         partialbar=partialbar,offset=0,
+                         btchroma_barbts=btchroma_barbts,precision=precision)
+    if feats == None:
+        return [None] * len(offsets)
+    realSize = pSize
+    if partialbar > 0:
+        realSize = partialbar
+    return [apply_offset(feats,offset,realSize) for offset in offsets]
+
+
 def analysis_dict_to_matfile(analysis_dict,filename):
     """
     Takes an analysis dictionary and writes it as a matlab file
@@ -167,7 +199,7 @@ def analysis_dict_to_matfile(analysis_dict,filename):
 
 def features_from_matfile(filename,pSize=8,usebars=2,keyInv=True,
                           songKeyInv=False,positive=True,do_resample=True,
-                          partialbar=0,offset=0):
+                          partialbar=0,offset=0,precision='float64'):
     """
     Function to help the transition from the BostonHackDay project.
     Loads a matlab file containing beat features.
@@ -181,26 +213,44 @@ def features_from_matfile(filename,pSize=8,usebars=2,keyInv=True,
 
     Real job done by get_features(...), for details look at it.
     """
+    return features_from_matfile_offsets(filename,[offset],pSize=pSize,
+                                         usebars=usebars,keyInv=keyInv,
+                                         songKeyInv=songKeyInv,
+                                         positive=positive,
+                                         do_resample=do_resample,
+                                         partialbar=partialbar,
+                                         precision=precision)[0]
+
+
+def features_from_matfile_offsets(filename,offsets,pSize=8,usebars=2,
+                                  keyInv=True,songKeyInv=False,positive=True,
+                                  do_resample=True,partialbar=0,
+                                  precision='float64'):
+    """
+    Same as features_from_matfile() for a list of offsets, the file
+    is loaded once, see get_features_offsets().
+    Returns a list of features, one per offset (None if problem)
+    """
     if sys.version_info[1] <= 5:
         mat = sp.io.loadmat(filename)
     else:
         mat = sp.io.loadmat(filename, struct_as_record=True)
     # weird cases from matfiles
     if type(mat['barbts']) == type(0.0):
-        return None
+        return [None] * len(offsets)
     if len(mat['btchroma'].shape) < 2:
-        return None
+        return [None] * len(offsets)
     if mat['btchroma'].shape[1] == 0:
-        return None
+        return [None] * len(offsets)
 
     analysis = (mat['btchroma'], mat['barbts'])
     # call the function that does the actual work
     # analysis_dict (1st param) useless, set to None or anything else
-    return get_features(None,pSize=pSize,usebars=usebars,
-                        keyInv=keyInv,songKeyInv=songKeyInv,
-                        positive=positive,do_resample=do_resample,
-                        partialbar=partialbar,offset=offset,
-                        btchroma_barbts=analysis)
+    return get_features_offsets(None,offsets,pSize=pSize,usebars=usebars,
+                                keyInv=keyInv,songKeyInv=songKeyInv,
+                                positive=positive,do_resample=do_resample,
+                                partialbar=partialbar,
+                                btchroma_barbts=analysis,precision=precision)
 
 
 def create_beat_synchro_chromagram(analysis_dict):
@@ -242,10 +292,10 @@ def create_beat_synchro_chromagram(analysis_dict):
     # CHROMA PER BEAT
     # Move segment chromagram onto a regular grid
     # result for track: 'TR0002Q11C3FA8332D'
-    #    warpmat.shape = (304, 708)
+    #    warpmat.shape = (304, 708), sparse
     #    btchroma.shape = (304, 12)
-    warpmat = get_time_warp_matrix(segstart, btstart, duration)
-    btchroma = np.dot(warpmat, segchroma.T).T
+    warpmat = get_time_warp_sparse(segstart, btstart, duration)
+    btchroma = warpmat.dot(segchroma.T).T
     if btchroma.shape[1] == 0:
         return None, None
     assert btchroma.shape[0] == 12, 'bad btchroma shape'
@@ -256,22 +306,71 @@ def create_beat_synchro_chromagram(analysis_dict):
     btchroma = (btchroma / maxs)
 
     # get the bars in number of beats, do I need that?
-    barbts = np.zeros(barstart.shape)
-    # get the first (only?) beat the starts at the same time as the bar
-    for n, x in enumerate(barstart):
-        barbts[n] = np.nonzero((btstart - x) == 0)[0][0]
+    barbts = get_barbts(barstart, btstart)
 
     # done, return chroma per beat
     return btchroma, barbts
 
 
+def get_barbts(barstart, btstart):
+    """
+    Used by create_beat_synchro_chromagram
+    Returns the beginning of bars as a beat index: for each bar, the
+    first beat that starts at the same time as the bar.
+    One lookup in the sorted beat starts (stable sort, so we get
+    the first beat if two start at the same time).
+    Raises IndexError if a bar does not start on a beat.
+    """
+    barstart = np.asarray(barstart).flatten()
+    btstart = np.asarray(btstart).flatten()
+    barbts = np.zeros(barstart.shape)
+    if barstart.shape[0] == 0:
+        return barbts
+    order = np.argsort(btstart, kind='mergesort')
+    sorted_btstart = btstart[order]
+    pos = np.searchsorted(sorted_btstart, barstart, side='left')
+    pos[np.where(pos >= len(btstart))] = 0
+    if len(btstart) == 0 or (sorted_btstart[pos] != barstart).any():
+        raise IndexError('a bar does not start on a beat')
+    barbts[:] = order[pos]
+    return barbts
+
+
 def get_time_warp_matrix(segstart, btstart, duration):
     """
     Used by create_beat_synchro_chromagram
     Returns a matrix (#beats,#segs)
     #segs should be larger than #beats, i.e. many events or segs
     happen in one beat.
+    Dense version of get_time_warp_sparse()
     """
+    return get_time_warp_sparse(segstart, btstart, duration).toarray()
+
+
+def get_time_warp_sparse(segstart, btstart, duration):
+    """
+    Used by create_beat_synchro_chromagram
+    Returns a sparse matrix (CSR) (#beats,#segs), see
+    get_time_warp_matrix()
+    A beat only covers a few segments: we find the first and last
+    segment of every beat with searchsorted (segment starts are
+    sorted), and fill only these entries.
+    The rare beats that do not follow the general case (beat before
+    the first segment, empty beat) are done by _time_warp_column().
+    """
+    segstart = np.asarray(segstart, dtype='float64').flatten()
+    btstart = np.asarray(btstart, dtype='float64').flatten()
+    nSegs = len(segstart)
+    nBeats = len(btstart)
+    # unsorted segments, do it the slow way
+    if (np.diff(segstart) < 0).any():
+        warpmat = np.zeros((nSegs, nBeats))
+        for n in xrange(nBeats):
+            col = _time_warp_column(segstart, btstart, duration, n)
+            if col == None:
+                break
+            warpmat[:, n] = col
+        return scipy.sparse.csr_matrix(warpmat.T)
 
     # length of beats and segments in seconds
     # result for track: 'TR0002Q11C3FA8332D'
@@ -280,46 +379,116 @@ def get_time_warp_matrix(segstart, btstart, duration):
     #    duration = 238.91546    meaning approx. 3min59s
     seglen = np.concatenate((segstart[1:], [duration])) - segstart
     btlen = np.concatenate((btstart[1:], [duration])) - btstart
-
-    warpmat = np.zeros((len(segstart), len(btstart)))
-    # iterate over beats (columns of warpmat)
-    for n in xrange(len(btstart)):
-        # beat start time and end time in seconds
-        start = btstart[n]
-        end = start + btlen[n]
-        # np.nonzero returns index of nonzero elems
-        # find first segment that starts after beat starts - 1
-        try:
-            start_idx = np.nonzero((segstart - start) >= 0)[0][0] - 1
-        except IndexError:
-            # no segment start after that beats, can happen close
-            # to the end, simply ignore, maybe even break?
-            # (catching faster than ckecking... it happens rarely?)
-            break
-        # find first segment that starts after beat ends
-        segs_after =  np.nonzero((segstart - end) >= 0)[0]
-        if segs_after.shape[0] == 0:
-            end_idx = start_idx
-        else:
-            end_idx = segs_after[0]
-        # fill col of warpmat with 1 for the elem in between
-        # (including start_idx, excluding end_idx)
-        warpmat[start_idx:end_idx, n] = 1
-        
-        # if the beat started after the segment, keep the proportion
-        # of the segment that is inside the beat
-        warpmat[start_idx, n] = 1. - ((start - segstart[start_idx])
-                                 / seglen[start_idx])
-        # if the segment ended after the beat ended, keep the proportion
-        # of the segment that is inside the beat
-        if end_idx - 1 > start_idx:
-            warpmat[end_idx-1,n] = ((end - segstart[end_idx-1])
-                                    / seglen[end_idx-1])
-        # normalize so the 'energy' for one beat is one
-        warpmat[:,n] /= np.sum(warpmat[:,n])
-
-    # return the transpose, meaning (#beats , #segs)
-    return warpmat.T
+    btend = btstart + btlen
+
+    # first segment that starts after beat starts - 1
+    start_idx = np.searchsorted(segstart, btstart, side='left') - 1
+    # no segment start after that beat, can happen close to the end,
+    # we stop there
+    nodata = np.nonzero(start_idx == nSegs - 1)[0]
+    if nodata.shape[0] > 0:
+        nBeatsUsed = nodata[0]
+    else:
+        nBeatsUsed = nBeats
+    start_idx = start_idx[:nBeatsUsed]
+    # first segment that starts after beat ends, or start_idx if none
+    end_idx = np.searchsorted(segstart, btend[:nBeatsUsed], side='left')
+    end_idx[np.where(end_idx == nSegs)] = start_idx[np.where(end_idx == nSegs)]
+
+    # segments from start_idx to end_idx (excluded), at least one
+    counts = np.maximum(end_idx - start_idx, 1)
+    # if the beat started after the segment, keep the proportion
+    # of the segment that is inside the beat
+    # (indices are clipped for the special cases, not used)
+    first = np.maximum(start_idx, 0)
+    firstval = 1. - ((btstart[:nBeatsUsed] - segstart[first])
+                     / seglen[first])
+    # if the segment ended after the beat ended, keep the proportion
+    # of the segment that is inside the beat
+    last = np.maximum(end_idx - 1, 0)
+    lastval = ((btend[:nBeatsUsed] - segstart[last])
+               / seglen[last])
+    # general case: the beat starts after the first segment, and
+    # its 'energy' is not zero
+    regular = (start_idx >= 0) & ((counts > 1) | (firstval != 0))
+    counts[np.where(~regular)] = 0
+    indptr = np.zeros(nBeats + 1, dtype='int')
+    indptr[1:nBeatsUsed+1] = np.cumsum(counts)
+    indptr[nBeatsUsed+1:] = indptr[nBeatsUsed]
+    firsts = indptr[:nBeatsUsed][regular]
+    lasts = indptr[1:nBeatsUsed+1][regular] - 1
+    indices = (np.arange(indptr[-1]) - np.repeat(indptr[:nBeatsUsed], counts)
+               + np.repeat(start_idx, counts))
+    data = np.ones(indptr[-1])
+    data[firsts] = firstval[regular]
+    ended = np.where(lasts > firsts)
+    data[lasts[ended]] = lastval[regular][ended]
+    # normalize so the 'energy' for one beat is one
+    if len(firsts) > 0:
+        data /= np.repeat(np.add.reduceat(data, firsts), counts[regular])
+    warpmat = scipy.sparse.csr_matrix((data, indices, indptr),
+                                      shape=(nBeats, nSegs))
+
+    # other beats, done as in the dense version
+    others = np.nonzero(~regular)[0]
+    if others.shape[0] > 0:
+        rows = []
+        cols = []
+        vals = []
+        for n in others:
+            col = _time_warp_column(segstart, btstart, duration, n)
+            nz = np.nonzero(col)[0]
+            rows.append(np.ones(len(nz), dtype='int') * n)
+            cols.append(nz)
+            vals.append(col[nz])
+        warpmat = warpmat + scipy.sparse.csr_matrix((np.concatenate(vals),
+                                                     (np.concatenate(rows),
+                                                      np.concatenate(cols))),
+                                                    shape=(nBeats, nSegs))
+    return warpmat
+
+
+def _time_warp_column(segstart, btstart, duration, n):
+    """
+    Column n of the (#segs,#beats) warp matrix, done the slow way,
+    or None if no segment starts after beat n.
+    Used by get_time_warp_sparse() for the special cases.
+    """
+    seglen = np.concatenate((segstart[1:], [duration])) - segstart
+    btlen = np.concatenate((btstart[1:], [duration])) - btstart
+    col = np.zeros(len(segstart))
+    # beat start time and end time in seconds
+    start = btstart[n]
+    end = start + btlen[n]
+    # np.nonzero returns index of nonzero elems
+    # find first segment that starts after beat starts - 1
+    try:
+        start_idx = np.nonzero((segstart - start) >= 0)[0][0] - 1
+    except IndexError:
+        # no segment start after that beats, can happen close
+        # to the end
+        return None
+    # find first segment that starts after beat ends
+    segs_after =  np.nonzero((segstart - end) >= 0)[0]
+    if segs_after.shape[0] == 0:
+        end_idx = start_idx
+    else:
+        end_idx = segs_after[0]
+    # fill col with 1 for the elem in between
+    # (including start_idx, excluding end_idx)
+    col[start_idx:end_idx] = 1
+    # if the beat started after the segment, keep the proportion
+    # of the segment that is inside the beat
+    col[start_idx] = 1. - ((start - segstart[start_idx])
+                           / seglen[start_idx])
+    # if the segment ended after the beat ended, keep the proportion
+    # of the segment that is inside the beat
+    if end_idx - 1 > start_idx:
+        col[end_idx-1] = ((end - segstart[end_idx-1])
+                          / seglen[end_idx-1])
+    # normalize so the 'energy' for one beat is one
+    col /= np.sum(col)
+    return col
 
 
 
@@ -329,25 +498,41 @@ def pad_crop(data, newsize):
     assert data.shape[1] > 0
     if data.shape[1] == newsize:
         return data
-    # data too small
-    if data.shape[1] < newsize:
-        res = np.zeros([12,newsize])
-        res[:,:data.shape[1]] = data
-        return res
-    # data too big
-    else:
-        return data[:,:newsize]
-        
+    return np.dot(data,resize_matrix(data.shape[1],newsize,False))
+
 
 def resample(data, newsize):
     """ resample the data, columnwise """
     assert data.shape[1] > 0
-    if newsize > 1:
-        return scipy.signal.resample(data, newsize, axis=1)
-    # special case, newsize == 1
     if newsize == 1 and data.shape[1] == 1:
         return data
-    return np.mean(data,axis=1).reshape(data.shape[0],1)
+    return np.dot(data,resize_matrix(data.shape[1],newsize,True))
+
+
+# resizing matrices, see resize_matrix()
+_resize_matrices = {}
+
+def resize_matrix(size, newsize, do_resample=True):
+    """
+    Returns the matrix (size,newsize) M such that np.dot(data,M)
+    resizes data (columnwise, data.shape[1]==size) to newsize.
+    If do_resample, same as scipy.signal.resample (FFT, it is
+    linear) or the mean if newsize == 1, otherwise pad with zeros
+    or crop.
+    Matrices are computed once per (size,newsize), bar lengths take
+    only a few values.
+    """
+    key = (size,newsize,do_resample)
+    if not _resize_matrices.has_key(key):
+        if not do_resample:
+            mat = np.eye(size,newsize)
+        elif newsize == 1:
+            mat = np.ones([size,1]) / size
+        else:
+            mat = scipy.signal.resample(np.eye(size),newsize,axis=1)
+        mat.setflags(write=False)
+        _resize_matrices[key] = mat
+    return _resize_matrices[key]
 
 
 def keyinvariance(pattern,retRoll=False):
@@ -369,6 +554,26 @@ def keyinvariance(pattern,retRoll=False):
     return np.roll(pattern,roll,axis=0),roll
 
 
+def keyinvariance_batch(patterns,retRoll=False):
+    """
+    Same as keyinvariance() on every pattern of a
+    (nPatterns,12,pSize) array, at once.
+    Max energy rows are computed together, and all rotations are
+    done with one indexing.
+    If retRoll == True, we also return the rolls, one per pattern.
+    """
+    nPatterns,nRows = patterns.shape[:2]
+    # find max rows
+    max_r = np.argmax(np.sum(patterns,axis=2),axis=1)
+    rolls = nRows - max_r
+    # roll, row i of the result is row (i - roll) of the pattern
+    rows = (np.arange(nRows)[np.newaxis,:] - rolls[:,np.newaxis]) % nRows
+    res = patterns[np.arange(nPatterns)[:,np.newaxis],rows]
+    if not retRoll:
+        return res
+    return res,rolls
+
+
 
 def filename_to_beatfeat_mat(filename,savefile=''):
     """
@@ -392,17 +597,14 @@ def filename_to_beatfeat_mat(filename,savefile=''):
     # warp it!
     # see get_echo_nest_metadata.get_beat_synchronous_chromagram()
     segchroma = pitches.T
-    warpmat = get_time_warp_matrix(segstart, btstart, dur)
-    btchroma = np.dot(warpmat, segchroma)
+    warpmat = get_time_warp_sparse(segstart, btstart, dur)
+    btchroma = warpmat.dot(segchroma)
     # Renormalize.
     btchroma = (btchroma.T / btchroma.max(axis=1)).T
     # get the start time of bars
     # result for track: 'TR0002Q11C3FA8332D'
     #    barstart.shape = (98,)
-    barbts = np.zeros(barstart.shape)
-    # get the first (only?) beat the starts at the same time as the bar
-    for n, x in enumerate(barstart):
-        barbts[n] = np.nonzero((btstart - x) == 0)[0][0]
+    barbts = get_barbts(barstart, btstart)
     # save to matlab file, see:
     # get_echo_nest_metadata.convert_matfile_to_beat_synchronous_chromagram()
 
@@ -26,9 +26,11 @@ import oracle_matfiles
 
 def initialize(nCodes,pSize=8,usebars=2,keyInv=True,songKeyInv=False,
                positive=True,do_resample=True,partialbar=0,nThreads=4,
-               oracle='EN',artistsdb='',matdir='',randoffset=False):
+               oracle='EN',artistsdb='',matdir='',randoffset=False,
+               precision='float64'):
     """
     Function to initialize a codebook, return the codebook as numpy array.
+    precision is 'float64' or 'float32', type of the codebook.
     """
 
     # creates a dictionary with all parameters
@@ -38,15 +40,15 @@ def initialize(nCodes,pSize=8,usebars=2,keyInv=True,songKeyInv=False,
               'do_resample':do_resample, 'partialbar':partialbar,
               'nThreads':nThreads, 'oracle':oracle,
               'artistsdb':artistsdb, 'matdir':matdir,
-              'randoffset':randoffset}
+              'randoffset':randoffset, 'precision':precision}
 
 
     # create codebook
     assert nCodes > 0,'nCodes inferior to 1? come on... codebook size!'
     if partialbar == 0:
-        codebook = np.zeros([nCodes,12*pSize])
+        codebook = np.zeros([nCodes,12*pSize],dtype=precision)
     else:
-        codebook = np.zeros([nCodes,12*partialbar])
+        codebook = np.zeros([nCodes,12*partialbar],dtype=precision)
     cbidx = 0 # which code are we initializing
 
 
@@ -112,6 +114,7 @@ def die_with_usage():
     print '                   used by EchoNest oracle'
     print ' -oraclemat d      matfiles oracle, d: matfiles dir'
     print ' -randoffset       uses a random offset for each track ranging from 0 to 3'
+    print ' -float32          codebook in single precision'
     print ''
     print 'typical command to initialize from codebook:'
     print '  python -O initializer.py -pSize 8 -usebars 2 -artistsdb artists28March.db 100 ~/experiment_dir/newexp/codebook.mat'
@@ -144,6 +147,7 @@ if __name__ == '__main__' :
     artistsdb = ''
     matdir = ''
     randoffset = False
+    precision = 'float64'
     while True:
         if sys.argv[1] == '-pSize':
             pSize = int(sys.argv[2])
@@ -185,6 +189,9 @@ if __name__ == '__main__' :
         elif sys.argv[1] == '-randoffset':
             randoffset = True
             print 'randoffset =', randoffset
+        elif sys.argv[1] == '-float32':
+            precision = 'float32'
+            print 'precision =', precision
         else:
             break
         sys.argv.pop(1)
@@ -199,7 +206,8 @@ if __name__ == '__main__' :
                           songKeyInv=songKeyInv,positive=positive,
                           do_resample=do_resample,partialbar=partialbar,
                           nThreads=nThreads,oracle=oracle,artistsdb=artistsdb,
-                          matdir=matdir,randoffset=randoffset)
+                          matdir=matdir,randoffset=randoffset,
+                          precision=precision)
 
     # save codebook
     scipy.io.savemat(filename,{'codebook':codebook})
@@ -11,15 +11,16 @@ tb2332@columbia.edu
 import sys
 import copy
 import time
+import multiprocessing
 import numpy as np
-from collections import deque
-# too hard to install for python 2.4 (I know, 2.4, pfff)
-try:
-    import scikits.ann as ann
-    _ann_imported = True
-except:
-    print 'working without ann, slower'
-    _ann_imported = False
+import search_backends as BACKENDS
+
+# max number of pattern / code distances held in memory at once
+DEFAULT_CHUNKSIZE = 2**22
+
+# model and patterns shared with the forked workers of predicts_parallel()
+_shared_model = None
+_shared_feats = None
 
 
 class Model:
@@ -28,17 +29,208 @@ class Model:
     gradient descent using the online vector quantization algorithm.
     """
 
-    def __init__(self,codewords):
+    # attributes derived from the codebook, they are not pickled
+    _search_caches = ('_cbnorms','_backend','_backend_auto','_index_dirty',
+                      '_index_maxmoved','_code_order','_code_order_hits')
+
+    def __init__(self,codewords,chunksize=DEFAULT_CHUNKSIZE,
+                 updatemode='sequential',indexmaxdirty=.05,indexmaxdisp=None,
+                 backend='auto',precision=None,rerank=0,approx=0.,
+                 recallevery=10000,recallsample=100,rotinv=False):
         """
         Constructor.
         Needs an initialized codebook, one code per line.
+        chunksize is the max number of pattern / code distances
+        computed at once when searching, it bounds memory usage.
+        updatemode is 'sequential' or 'minibatch', see update_codebook()
+        indexmaxdirty and indexmaxdisp are the staleness budget of the
+        search index: it is rebuilt when more than that fraction of
+        codes moved, or when a code moved further than indexmaxdisp
+        (None = no limit), since the last build.
+        backend is the name of the search backend, or 'auto' to
+        pick the fastest one on this machine, see search_backends.py
+        precision is 'float32' or 'float64' for the codebook, distances
+        and updates, None to keep the type of codewords.
+        rerank: if > 1, the brute force search re-ranks that many best
+        codes in float64, useful in float32 where ties matter.
+        Other backends ignore it, 'auto' then picks brute force.
+        approx: eps of the kd-tree backends, the code found is at most
+        (1+eps) times further than the closest one; 0 for exact search.
+        Other backends do not support it, 'auto' then picks a kd-tree.
+        With approximate search, every recallevery patterns we compare
+        recallsample of them to the exact answer, see approx_report().
+        rotinv: if True, patterns are matched over their 12 chroma
+        rotations, see predicts_rotinv(), and codes are updated with
+        the rotated patterns.
+        rerank and approx can't be used together, no backend does both.
         """
-        self._codebook = copy.deepcopy(codewords)
+        assert rerank <= 1 or approx == 0,('rerank needs brute force, approx'
+                                           ' needs a kd-tree: use one or the other')
+        if precision is None:
+            self._codebook = copy.deepcopy(codewords)
+        else:
+            self._codebook = np.array(codewords,dtype=precision)
         self._nCodes = codewords.shape[0]
         self._codesize = codewords.shape[1]
         self._dist = euclidean_dist
+        self._chunksize = chunksize
+        self._updatemode = updatemode
+        self._indexmaxdirty = indexmaxdirty
+        self._indexmaxdisp = indexmaxdisp
+        self._backend_name = backend
+        self._rerank = rerank
+        self._approx = approx
+        self._recallevery = recallevery
+        self._recallsample = recallsample
+        self._rotinv = rotinv
+        self._set_default_attributes()
 
 
+    def _set_default_attributes(self):
+        """
+        Set the attributes that are not part of the codebook itself
+        if they do not exist yet, and reset the search caches.
+        Called by the constructor and when unpickling, models
+        saved by older code do not have them.
+        """
+        if not hasattr(self,'_chunksize'):
+            self._chunksize = DEFAULT_CHUNKSIZE
+        if not hasattr(self,'_updatemode'):
+            self._updatemode = 'sequential'
+        if not hasattr(self,'_indexmaxdirty'):
+            self._indexmaxdirty = .05
+        if not hasattr(self,'_indexmaxdisp'):
+            self._indexmaxdisp = None
+        if not hasattr(self,'_backend_name'):
+            self._backend_name = 'auto'
+        if not hasattr(self,'_rerank'):
+            self._rerank = 0
+        if not hasattr(self,'_approx'):
+            self._approx = 0.
+            self._recallevery = 10000
+            self._recallsample = 100
+        if not hasattr(self,'_approx_stats'):
+            self.reset_approx_stats()
+        if not hasattr(self,'_code_hits'):
+            self._code_hits = np.zeros(self._nCodes,dtype='int64')
+        if not hasattr(self,'_version'):
+            self._version = 0
+        if not hasattr(self,'_rotinv'):
+            self._rotinv = False
+        # unpickled or new codebook, not seen by any snapshot
+        self._codebook_shared = False
+        self._reset_search_caches()
+
+    def _reset_search_caches(self):
+        """
+        Forget everything derived from the codebook, it is
+        recomputed when needed.
+        """
+        # squared norm of each code
+        self._cbnorms = None
+        # search backend, and the one picked by calibration if 'auto'
+        # (machine dependent, not saved)
+        self._backend = None
+        self._backend_auto = None
+        # for static backends: the codes that moved since it was
+        # built and how far the furthest went
+        self._index_dirty = None
+        self._index_maxmoved = 0.
+        # codes sorted by decreasing number of hits, and the total
+        # number of hits when it was sorted
+        self._code_order = None
+        self._code_order_hits = 0
+
+    def set_backend(self,backend):
+        """
+        Changes the search backend, a name from search_backends.py
+        or 'auto'.
+        """
+        self._backend_name = backend
+        self._backend = None
+
+    def __getstate__(self):
+        """
+        For pickle. Search caches are derived from the codebook,
+        we do not save them.
+        """
+        state = self.__dict__.copy()
+        for k in self._search_caches:
+            if state.has_key(k):
+                del state[k]
+        return state
+
+    def __setstate__(self,state):
+        """
+        For pickle. Works with models saved by older code.
+        """
+        self.__dict__.update(state)
+        self._set_default_attributes()
+
+    def _get_cbnorms(self):
+        """
+        Returns the squared norm of each code, cached.
+        """
+        if self._cbnorms is None:
+            self._cbnorms = np.square(self._codebook).sum(axis=1)
+        return self._cbnorms
+
+    def _codes_moved(self,idxs):
+        """
+        Must be called when the codes in idxs have been modified,
+        keeps the search caches up to date.
+        """
+        if self._cbnorms is not None:
+            self._cbnorms[idxs] = np.square(self._codebook[idxs]).sum(axis=1)
+        if self._backend is None:
+            return
+        if not self._backend.static:
+            self._backend.codes_moved(idxs)
+            return
+        self._index_dirty[idxs] = True
+        if self._indexmaxdisp is not None and len(idxs) > 0:
+            disp = euclidean_dist_batch(self._codebook[idxs],
+                                        self._backend.codebook[idxs])
+            self._index_maxmoved = max(self._index_maxmoved,disp.max())
+
+    def _index_is_stale(self):
+        """
+        True if too many codes moved since the static search backend
+        was built, see the staleness budget in the constructor.
+        """
+        nDirty = np.sum(self._index_dirty)
+        if nDirty > self._indexmaxdirty * self._nCodes:
+            return True
+        if self._indexmaxdisp is not None:
+            return self._index_maxmoved > self._indexmaxdisp
+        return False
+
+    def _get_backend(self,nFeats,lrate=0.):
+        """
+        Returns the search backend, creates it if needed, or rebuilds
+        it if it is static and stale.
+        If the backend is 'auto', the first call runs a short calibration
+        with batches of nFeats patterns, on updates with learning rate
+        lrate (0 = search only), see search_backends.calibrate().
+        """
+        if self._backend is not None:
+            if not self._backend.static or not self._index_is_stale():
+                return self._backend
+        name = self._backend_name
+        if name == 'auto':
+            if self._backend_auto is None:
+                self._backend_auto = BACKENDS.calibrate(self,nFeats,lrate=lrate)
+                print 'search backend chosen by calibration:',self._backend_auto
+            name = self._backend_auto
+        assert self._approx == 0 or BACKENDS.BACKENDS[name].approx,'approx > 0 needs a kd-tree search backend (ckdtree, ann), not %s.'%name
+        if self._backend is None and self._rerank > 1 and not BACKENDS.BACKENDS[name].rerank:
+            print 'WARNING: rerank is ignored by the search backend',name,'(use brute)'
+        self._backend = BACKENDS.create_backend(name,self)
+        if self._backend.static:
+            self._index_dirty = np.zeros(self._nCodes,dtype='bool')
+            self._index_maxmoved = 0.
+        return self._backend
+
     def update(self,feats,lrate=1e-5):
         """
         Receives a set of features (one pattern per line)
@@ -50,66 +242,303 @@ class Model:
         Note that we do minibatch, not exactly online, because
         updating the kdtree takes time for not much if learning
         rate is low.
+        The codes are then moved according to self._updatemode,
+        see update_codebook().
 
         Return avg_dist (mean squared distance per pixel)
         """
         # remove empty patterns
         feats = feats[np.nonzero(np.sum(feats,axis=1))]
+        feats = np.asarray(feats,dtype=self._codebook.dtype)
+        # search backend picked on updates, not only searches
+        if not self._rotinv:
+            self._get_backend(feats.shape[0],lrate=lrate)
         # predicts on the features
-        best_code_per_p,dists = self.predicts(feats)
+        if self._rotinv:
+            best_code_per_p,dists,rolls = self.predicts_rotinv(feats)
+            feats = roll_patterns(feats,rolls)
+        else:
+            best_code_per_p,dists = self.predicts(feats)
         # update codebook
-        for idx in range(feats.shape[0]):
-            cidx = best_code_per_p[idx]
-            self._codebook[cidx,:] += (feats[idx,:] - self._codebook[cidx,:]) * lrate
+        self._update_codes(feats,best_code_per_p,lrate)
         # return mean dists
         return np.average(dists)
 
+    def _update_codes(self,feats,codes,lrate):
+        """
+        Moves the codes toward the patterns assigned to them,
+        and keeps the search caches up to date.
+        """
+        self._copy_on_write()
+        moved = update_codebook(self._codebook,feats,codes,lrate,
+                                mode=self._updatemode)
+        self._codes_moved(moved)
+        self._code_hits += np.bincount(codes,minlength=self._nCodes)
+        self._version += 1
+
+    def snapshot(self):
+        """
+        Returns a copy of the model frozen at this version (_version,
+        number of updates), for readers running predicts while we keep
+        training: validation, serving, saving.
+        The codebook is not copied, it is shared and made read-only;
+        the next update of this model copies it first (copy-on-write),
+        so a snapshot costs nothing if the model is not updated, and
+        one codebook copy per version otherwise.
+        Take snapshots from the thread that calls update().
+        """
+        self._codebook_shared = True
+        self._codebook.flags.writeable = False
+        # shallow copy through __getstate__ / __setstate__, fresh caches
+        snap = copy.copy(self)
+        snap._codebook_shared = True
+        snap._code_hits = self._code_hits.copy()
+        # readers update the recall counters in predicts()
+        snap._approx_stats = self._approx_stats.copy()
+        return snap
+
+    def _scratch_copy(self):
+        """
+        Returns a copy of the model that can be updated without
+        touching this one: own codebook, hits and stats, fresh
+        search caches. Used to calibrate the search backends.
+        """
+        # shallow copy through __getstate__ / __setstate__, fresh caches
+        scratch = copy.copy(self)
+        scratch._codebook = self._codebook.copy()
+        scratch._codebook_shared = False
+        scratch._code_hits = self._code_hits.copy()
+        scratch.reset_approx_stats()
+        return scratch
+
+    def _copy_on_write(self):
+        """
+        Call before modifying the codebook in place: if a snapshot
+        shares it, we get our own copy.
+        Search caches are still valid, same values.
+        """
+        if self._codebook_shared:
+            self._codebook = self._codebook.copy()
+            self._codebook_shared = False
+
+    def _get_code_order(self):
+        """
+        Returns the codes sorted by decreasing number of hits (patterns
+        used to update them), used by the search backends to try the
+        likely codes first.
+        Sorted again only when hits grew by 10% since the last sort,
+        the order changes slowly.
+        """
+        nHits = np.sum(self._code_hits)
+        if self._code_order is None or nHits > self._code_order_hits * 1.1:
+            self._code_order = np.argsort(-self._code_hits,kind='mergesort').astype('int32')
+            self._code_order_hits = nHits
+        return self._code_order
+
     def predicts(self,feats):
         """
         Returns two lists, best_code_per_pattern
         and average squared distance
 
         Note on method used:
-        Uses ann if we have many features. Reason:
-        during training, when we might look at one new sample
-        at a time then update the codebook, building a kdtree is
-        useless. If the model is trained and we want to predict on
-        a large database, t's worth having the kdtree.
-        Threshold set at 200 features.
+        The search is done by a backend (brute force with BLAS,
+        kd-trees, ...) chosen by name or by a short calibration on
+        this machine, see search_backends.py
+        Static backends (kd-trees) are kept between calls, and rebuilt
+        only when the codebook moved too much, see _closest_codes_index().
+        Codes are returned as int32.
+        Features are converted to the precision of the codebook.
+        If the model is rotation invariant, see predicts_rotinv().
         """
         assert feats.shape[1] > 0,'empty feats???'
-        # ann
-        use_ann = feats.shape[0] > 50 and _ann_imported
-        if use_ann:
-            kdtree = ann.kdtree(self._codebook)
-            best_code_per_p, dists = self._closest_code_ann(feats,kdtree)
-            best_code_per_p = np.array(best_code_per_p)
-            # note that dists is already squared euclidean distance
-            avg_dists = np.array(map(lambda x: x * 1. /feats.shape[1],dists))
-            if np.isnan(dists).any():
-                # sometimes ann has numerical errors, redo wrong ones
-                nan_idx = np.where(np.isnan(avg_dists))[0]
-                for idx in nan_idx:
-                    code,dist = self._closest_code_batch(feats[idx])
-                    best_code_per_p[idx] = int(code)
-                    avg_dists[idx] = dist * dist * 1. / feats.shape[1]
-                assert not np.isnan(avg_dists).any(),'NaN with ann not fixed'
-        if not use_ann:
-            # prepare result
-            best_code_per_p = np.zeros(feats.shape[0])
-            avg_dists = np.zeros(feats.shape[0])
-            idx = -1
-            # iterate over features
-            for f in feats:
-                idx += 1
-                code,dist = self._closest_code_batch(f)
-                best_code_per_p[idx] = int(code)
-                avg_dists[idx] = dist * dist * 1. / feats.shape[1]
-            assert not np.isnan(avg_dists).any(),'NaN with regular code'
+        if self._rotinv:
+            return self.predicts_rotinv(feats)[:2]
+        feats = np.asarray(feats,dtype=self._codebook.dtype)
+        backend = self._get_backend(feats.shape[0])
+        if backend.static:
+            best_code_per_p,sqdists = self._closest_codes_index(feats)
+        else:
+            best_code_per_p,sqdists = backend.query(feats)
+        if self._approx > 0 or not backend.exact:
+            self._measure_approx(feats,best_code_per_p,sqdists)
+        avg_dists = sqdists * 1. / feats.shape[1]
+        assert not np.isnan(avg_dists).any(),'NaN in predicts'
         # done, return two list
         return best_code_per_p, avg_dists
 
 
+    def predicts_rotinv(self,feats):
+        """
+        Same as predicts(), but every pattern is compared to the codes
+        in its 12 circular chroma rotations, we keep the best code and
+        rotation.
+        Returns best_code_per_pattern, average squared distance
+        and rolls: np.roll(pattern.reshape(12,pSize),roll,axis=0)
+        is the rotation that matches the code (as in
+        features.keyinvariance).
+        Rotation does not change the norms, so only the dot products
+        <roll(x,r),c> depend on r: it is a circular cross-correlation
+        along the chroma axis. In the Fourier domain (rfft, 7
+        frequencies) it is one product per frequency, then the inverse
+        transform gives the 12 rolls at once. Everything is done with
+        real matrix products, see _rotinv_matrices().
+        """
+        assert feats.shape[1] > 0,'empty feats???'
+        assert self._codesize % 12 == 0,'codes are not 12 x pSize patterns'
+        feats = np.asarray(feats,dtype=self._codebook.dtype)
+        nFeats = feats.shape[0]
+        pSize = self._codesize / 12
+        cbmats,invdft = self._rotinv_matrices()
+        nFreqs = len(cbmats)
+        cbnorms = self._get_cbnorms()
+        best_codes = np.zeros(nFeats,dtype='int32')
+        sqdists = np.zeros(nFeats)
+        rolls = np.zeros(nFeats,dtype='int32')
+        # spectrum and corr below are the big matrices
+        step = max(1,self._chunksize / (self._nCodes * (2 * nFreqs + 12)))
+        for start in range(0,nFeats,step):
+            x = feats[start:start+step]
+            nx = x.shape[0]
+            xfft = np.fft.rfft(x.reshape(nx,12,pSize),axis=1)
+            # spectrum[f] = [Re; Im] of conj(X_f) C_f, shape (2,nCodes,nx)
+            spectrum = np.empty([nFreqs,2*self._nCodes,nx],dtype=x.dtype)
+            for f in range(nFreqs):
+                xf = np.concatenate([xfft[:,f,:].real,xfft[:,f,:].imag],axis=1).astype(x.dtype)
+                np.dot(cbmats[f],xf.T,out=spectrum[f])
+            # corr[r,k,n] = <roll(x_n,r),c_k>
+            corr = np.dot(invdft,spectrum.reshape(2*nFreqs,-1))
+            corr = corr.reshape(12,self._nCodes,nx)
+            # ||c||^2 - 2 <roll(x),c>, enough to find the argmin
+            d = np.max(corr,axis=0) * -2.
+            d += cbnorms[:,np.newaxis]
+            best = np.argmin(d,axis=0)
+            best_codes[start:start+step] = best
+            rolls[start:start+step] = np.argmax(corr[:,best,np.arange(nx)],axis=0)
+            sqdists[start:start+step] = d[best,np.arange(nx)] + np.square(x).sum(axis=1)
+        # numerical errors can give tiny negative distances
+        sqdists[np.where(sqdists<0)] = 0
+        avg_dists = sqdists * 1. / feats.shape[1]
+        assert not np.isnan(avg_dists).any(),'NaN in predicts'
+        return best_codes, avg_dists, rolls
+
+    def _rotinv_matrices(self):
+        """
+        Matrices used by predicts_rotinv().
+        RETURN
+          one (2*nCodes, 2*pSize) matrix per rfft frequency f, it
+          maps [Re(X_f), Im(X_f)] to [Re; Im] of conj(X_f) C_f
+          the inverse rfft as a (12, 2*nFreqs) matrix on [Re; Im]
+        """
+        pSize = self._codesize / 12
+        cbfft = np.fft.rfft(self._codebook.reshape(self._nCodes,12,pSize),axis=1)
+        dtype = self._codebook.dtype
+        cbmats = []
+        for f in range(cbfft.shape[1]):
+            cr = cbfft[:,f,:].real
+            ci = cbfft[:,f,:].imag
+            # (xr - i xi)(cr + i ci) = xr cr + xi ci + i (xr ci - xi cr)
+            cbmats.append(np.asarray(np.bmat([[cr,ci],[ci,-cr]]),dtype=dtype))
+        nFreqs = cbfft.shape[1]
+        invdft = np.empty([12,2*nFreqs],dtype=dtype)
+        invdft[:,0::2] = np.fft.irfft(np.eye(nFreqs),n=12).T
+        invdft[:,1::2] = np.fft.irfft(1j*np.eye(nFreqs),n=12).T
+        return cbmats,invdft
+
+    def reset_approx_stats(self):
+        """
+        Forget what was measured on the approximate search.
+        """
+        # patterns until the next sample, patterns sampled, right
+        # codes, sum of approximate and exact squared distances
+        self._approx_stats = {'countdown':0,'nSampled':0,'nHits':0,
+                              'sumApprox':0.,'sumExact':0.}
+
+    def _measure_approx(self,feats,codes,sqdists):
+        """
+        Every recallevery patterns, compares a random sample of
+        the patterns to the exact search (brute force).
+        """
+        stats = self._approx_stats
+        stats['countdown'] -= feats.shape[0]
+        if stats['countdown'] > 0:
+            return
+        stats['countdown'] = self._recallevery
+        n = min(self._recallsample,feats.shape[0])
+        idxs = np.random.permutation(feats.shape[0])[:n]
+        exact_codes,exact_dists = self._closest_codes_blas(feats[idxs])
+        stats['nSampled'] += n
+        # python numbers, not numpy scalars: the stats go in
+        # model_nonumpy.p, see trainer.save_experiment()
+        # ties count as hits
+        stats['nHits'] += int(np.sum(np.logical_or(exact_codes == codes[idxs],
+                                                   sqdists[idxs] <= exact_dists)))
+        stats['sumApprox'] += float(np.sum(sqdists[idxs]))
+        stats['sumExact'] += float(np.sum(exact_dists))
+
+    def approx_report(self):
+        """
+        Measured quality of the approximate search, on the patterns
+        sampled since the last reset_approx_stats().
+        Returns recall (fraction of patterns given their closest code)
+        and excess distortion (relative increase of the sum of squared
+        distances compared to exact search), NaN if nothing sampled.
+        """
+        stats = self._approx_stats
+        if stats['nSampled'] == 0:
+            return np.nan,np.nan
+        recall = stats['nHits'] * 1. / stats['nSampled']
+        if stats['sumExact'] == 0:
+            return recall,0.
+        excess = stats['sumApprox'] / stats['sumExact'] - 1.
+        return recall,excess
+
+    def _closest_codes_index(self,feats):
+        """
+        Finds the closest code to any number of given samples
+        using a static search backend.
+        Results are exact: the backend knows the right position of
+        the codes that did not move since it was built, the codes
+        that moved (few of them) are checked by brute force.
+        When the backend answers with a code that moved, we can't know
+        the closest code that did not move, we redo that pattern.
+        Returns the indexes of the closest codes (int32)
+        and SQUARED euclidean distances
+        """
+        best_codes,sqdists = self._backend.query(feats)
+        # patterns to redo: wrong code, or numerical errors (ann)
+        redo = self._index_dirty[best_codes] | np.isnan(sqdists)
+        # compare the others with the codes that moved
+        dirty = np.where(self._index_dirty)[0]
+        check = np.where(np.logical_not(redo))[0]
+        if len(dirty) > 0 and len(check) > 0:
+            codes,dists = closest_codes_batch(self._codebook[dirty],
+                                              feats[check],
+                                              cbnorms=self._get_cbnorms()[dirty],
+                                              chunksize=self._chunksize)
+            better = np.where(dists < sqdists[check])[0]
+            best_codes[check[better]] = dirty[codes[better]]
+            sqdists[check[better]] = dists[better]
+        redo = np.where(redo)[0]
+        if len(redo) > 0:
+            codes,dists = self._closest_codes_blas(feats[redo])
+            best_codes[redo] = codes
+            sqdists[redo] = dists
+        return best_codes,sqdists
+
+    def _closest_codes_blas(self,feats):
+        """
+        Finds the closest code to any number of given samples
+        using matrix products, see closest_codes_batch().
+        Works well if the codebook is often modified, the codes
+        norms are cached and updated when codes move.
+        Returns the indexes of the closest codes (int32)
+        and SQUARED euclidean distances
+        """
+        return closest_codes_batch(self._codebook,feats,
+                                   cbnorms=self._get_cbnorms(),
+                                   chunksize=self._chunksize,
+                                   rerank=self._rerank)
+
     def _closest_code_batch(self,sample):
         """
         Efficiently compute the distance from one sample to all codewords.
@@ -122,17 +551,6 @@ class Model:
         return bestidx,dists[bestidx]
 
 
-    def _closest_code_ann(self,samples,kdtree):
-        """
-        Finds the closest code to any number of given samples.
-        Do it using a kd-tree, good if the codebook is not modified.
-        Returns the index of the closest code
-        and SQUARED euclidean distance (unlike _closest_code_batch)
-        """
-        res = kdtree.knn(samples,1)
-        return map(lambda x: int(x),res[0].flatten()), res[1].flatten()
-
-
 
 class ModelFilter(Model):
     """
@@ -143,52 +561,118 @@ class ModelFilter(Model):
     P.S. Uniorns rock!!!!
     """
 
-    def __init__(self,codewords):
+    def __init__(self,codewords,**kwargs):
         """
-        Constructor
+        Constructor, see Model for the optional parameters
         """
         # parent
-        Model.__init__(self,codewords)
+        Model.__init__(self,codewords,**kwargs)
         # for average dist per code
-        self._avg_dist_per_code = []
-        for k in range(self._nCodes):
-            self._avg_dist_per_code.append(deque())
         self._avg_dist_qlen = 200 # queue length
+        self._init_dist_buffers()
         self._nPatternReceived = 0 # everything submitted to update
         self._nPatternUsed = 0 # after discarding some
 
+    def _init_dist_buffers(self):
+        """
+        Last distances seen for every code, one ring buffer per code
+        (one row of a numpy array) with running sums.
+        """
+        self._dist_buffer = np.zeros([self._nCodes,self._avg_dist_qlen])
+        self._dist_count = np.zeros(self._nCodes,dtype='int32') # nb. dists in buffer
+        self._dist_pos = np.zeros(self._nCodes,dtype='int32') # next slot to write
+        self._dist_sum = np.zeros(self._nCodes)
+        self._dist_nAdded = 0 # since sums were recomputed
+
+    def __setstate__(self,state):
+        """
+        For pickle. Models saved by older code have one deque
+        of distances per code, we move them to the ring buffers.
+        model_nonumpy.p has the ring buffers as lists.
+        """
+        Model.__setstate__(self,state)
+        if type(getattr(self,'_dist_buffer',None)) == type([]):
+            self._dist_buffer = np.array(self._dist_buffer,dtype='float')
+            self._dist_sum = np.array(self._dist_sum,dtype='float')
+            self._dist_count = np.array(self._dist_count,dtype='int32')
+            self._dist_pos = np.array(self._dist_pos,dtype='int32')
+        if hasattr(self,'_avg_dist_per_code'):
+            queues = self._avg_dist_per_code
+            del self._avg_dist_per_code
+            self._init_dist_buffers()
+            codes = [np.ones(len(q),dtype='int32') * k for k,q in enumerate(queues)]
+            dists = [np.array(q,dtype='float') for q in queues]
+            self._add_dists(np.concatenate(dists),np.concatenate(codes))
+
+    def snapshot(self):
+        """
+        See Model.snapshot(), distances per code are copied, they
+        change with every update.
+        """
+        snap = Model.snapshot(self)
+        for k in ('_dist_buffer','_dist_count','_dist_pos','_dist_sum'):
+            setattr(snap,k,getattr(self,k).copy())
+        return snap
 
-    def _add_dist(self,dist,codeidx):
+    def _add_dists(self,dists,codes):
         """
-        Add a new distance to one of the codes.
+        Add new distances, dists[k] goes to code codes[k].
+        If a code receives more than the queue length, only the
+        last ones are kept.
         """
-        self._avg_dist_per_code[codeidx].append(dist)
-        if len(self._avg_dist_per_code[codeidx]) > self._avg_dist_qlen:
-            self._avg_dist_per_code[codeidx].popleft()
+        if len(codes) == 0:
+            return
+        qlen = self._avg_dist_qlen
+        # group by code, keep the order within a code
+        order = np.argsort(codes,kind='mergesort')
+        codes = codes[order]
+        dists = dists[order]
+        starts = np.concatenate([[0],np.where(np.diff(codes))[0]+1])
+        counts = np.diff(np.concatenate([starts,[len(codes)]]))
+        ucodes = codes[starts]
+        ranks = np.arange(len(codes)) - np.repeat(starts,counts)
+        keep = np.where(ranks >= np.repeat(counts,counts) - qlen)[0]
+        codes = codes[keep]
+        dists = dists[keep]
+        slots = (self._dist_pos[codes] + ranks[keep]) % qlen
+        # update running sums, empty slots contain 0
+        np.add.at(self._dist_sum,codes,dists - self._dist_buffer[codes,slots])
+        self._dist_buffer[codes,slots] = dists
+        self._dist_pos[ucodes] = (self._dist_pos[ucodes] + counts) % qlen
+        self._dist_count[ucodes] = np.minimum(self._dist_count[ucodes] + counts,qlen)
+        # recompute sums once in a while, rounding errors add up
+        self._dist_nAdded += len(codes)
+        if self._dist_nAdded > self._nCodes * qlen:
+            self._dist_sum = self._dist_buffer.sum(axis=1)
+            self._dist_nAdded = 0
 
     def _get_avg_dist(self,codeidx):
         """
         Return average distance for a particular codeword, or None
         if no data is available
         """
-        if len(self._avg_dist_per_code[codeidx]) == 0:
+        if self._dist_count[codeidx] == 0:
             return None
-        return np.average(self._avg_dist_per_code[codeidx])
+        return self._dist_sum[codeidx] / self._dist_count[codeidx]
 
-    def _accept_prob(self,dist,codeidx):
+    def _accept_probs(self,dists,codes):
         """
-        Compute the probability of acceptance given a distance and
-        a particular codewords index.
+        Compute the probability of acceptance given distances and
+        the corresponding codewords indexes.
         """
-        if dist == 0:
-            return 0.
-        avg_dist_for_code = self._get_avg_dist(codeidx)
-        if avg_dist_for_code == None:
-            return 1.
+        probs = np.ones(len(codes))
+        counts = self._dist_count[codes]
+        # no division by zero, patterns at distance 0 get prob 0 below
+        idxs = np.where(np.logical_and(counts > 0,dists > 0))[0]
+        avg_dists = self._dist_sum[codes[idxs]] / counts[idxs]
         # logistic function on ratio 1/(1+exp(avg_dist/dist))
         # if ratio small, prob tends to 1
         # it's certain to be between 0 and 1 (excluded)
-        return 1. / (1. + np.exp(avg_dist_for_code / dist) )
+        # ratio clipped, exp() overflows after ~709 (prob is 0 anyway)
+        ratios = np.minimum(avg_dists / dists[idxs],700.)
+        probs[idxs] = 1. / (1. + np.exp(ratios))
+        probs[np.where(dists == 0)] = 0.
+        return probs
 
     def update(self,feats,lrate=1e-5):
         """
@@ -208,13 +692,21 @@ class ModelFilter(Model):
         """
         # remove empty patterns
         feats = feats[np.nonzero(np.sum(feats,axis=1))]
+        feats = np.asarray(feats,dtype=self._codebook.dtype)
         # stat
         self._nPatternReceived += feats.shape[0]
+        # search backend picked on updates, not only searches
+        if not self._rotinv:
+            self._get_backend(feats.shape[0],lrate=lrate)
         # predicts on the features
-        best_code_per_p,dists = self.predicts(feats)
+        if self._rotinv:
+            best_code_per_p,dists,rolls = self.predicts_rotinv(feats)
+            feats = roll_patterns(feats,rolls)
+        else:
+            best_code_per_p,dists = self.predicts(feats)
         #***************************************************
         # FILTER
-        probs = np.array(map(lambda k: self._accept_prob(dists[k],int(best_code_per_p[k])),range(feats.shape[0])))
+        probs = self._accept_probs(dists,best_code_per_p)
         idxs_to_keep = np.where((probs - np.random.rand(feats.shape[0]))>0)[0]
         if idxs_to_keep.shape[0] == 0:
             print 'UpdateFilter: kept 0 /',feats.shape[0],'patterns.'
@@ -224,19 +716,697 @@ class ModelFilter(Model):
         feats_select = feats[idxs_to_keep]
         print 'UpdateFilter: kept',feats_select.shape[0],'/',feats.shape[0],'patterns.'
         # add distances for improved avg. dist per code
-        map(lambda k: self._add_dist(dists_select[k],int(best_code_per_p_select[k])),range(feats_select.shape[0]))
+        self._add_dists(dists_select,best_code_per_p_select)
         # stat
         self._nPatternUsed += feats_select.shape[0]
         #***************************************************
         # update codebook
-        for idx in range(feats_select.shape[0]):
-            cidx = best_code_per_p_select[idx]
-            self._codebook[cidx,:] += (feats_select[idx,:] - self._codebook[cidx,:]) * lrate
+        self._update_codes(feats_select,best_code_per_p_select,lrate)
         # return mean dists
         return np.average(dists)
 
 
-    
+
+class ModelStructured:
+    """
+    Base class of the models whose codebook is made of small
+    codebooks (ModelPQ, ModelRVQ) or of the levels of a tree
+    (ModelTree). It handles the search caches (squared norms of
+    the codes) and pickling.
+    Subclasses set _codebook and call _set_default_attributes()
+    in their constructor.
+    """
+
+    def _set_default_attributes(self):
+        """
+        Reset the search caches, called by the constructor and
+        when unpickling.
+        """
+        # squared norms of the codes, see _get_cbnorms()
+        self._cbnorms = None
+
+    def __getstate__(self):
+        """
+        For pickle. Search caches are derived from the codebook,
+        we do not save them.
+        """
+        state = self.__dict__.copy()
+        del state['_cbnorms']
+        return state
+
+    def __setstate__(self,state):
+        """
+        For pickle.
+        """
+        self.__dict__.update(state)
+        self._set_default_attributes()
+
+    def _get_cbnorms(self):
+        """
+        Returns the squared norm of every subcode, cached, one
+        row per sub codebook.
+        """
+        if self._cbnorms is None:
+            self._cbnorms = np.square(self._codebook).sum(axis=2)
+        return self._cbnorms
+
+    def _update_feats(self,feats):
+        """
+        Patterns received by update(): without the empty ones, in
+        the type of the codebook.
+        """
+        feats = feats[np.nonzero(np.sum(feats,axis=1))]
+        return np.asarray(feats,dtype=self._codebook.dtype)
+
+
+class ModelPQ(ModelStructured):
+    """
+    Product quantization model. Patterns (12 x pSize) are cut in
+    nSubspaces blocks of consecutive beats, every block has its own
+    small codebook. A pattern is encoded by one subcode per block,
+    the full code being the combination of the subcodes.
+    With nSubCodes per block, we get nSubCodes^nSubspaces codes, i.e.
+    the same bitrate as Model with that many codes, for a fraction
+    of the search cost and memory.
+    The codebook is a 3D array: nSubspaces x nSubCodes x subcode size
+    """
+
+    def __init__(self,codewords,nSubspaces=2,chunksize=DEFAULT_CHUNKSIZE,
+                 updatemode='sequential'):
+        """
+        Constructor.
+        Needs an initialized codebook, one code per line, as for Model.
+        We use nCodes^(1/nSubspaces) subcodes per block (rounded),
+        initialized from the blocks of random codewords.
+        nSubspaces must divide pSize.
+        chunksize and updatemode: see Model
+        """
+        nCodes = codewords.shape[0]
+        self._codesize = codewords.shape[1]
+        assert self._codesize % 12 == 0,'codewords are not 12 x pSize patterns'
+        assert (self._codesize / 12) % nSubspaces == 0,'nSubspaces must divide pSize'
+        self._nSubspaces = nSubspaces
+        self._nSubCodes = int(np.round(nCodes ** (1. / nSubspaces)))
+        assert self._nSubCodes <= nCodes,'not enough codewords to initialize'
+        self._nCodes = self._nSubCodes ** nSubspaces
+        if self._nCodes != nCodes:
+            print 'ModelPQ: using',self._nCodes,'codes instead of',nCodes
+        self._chunksize = chunksize
+        self._updatemode = updatemode
+        # sub codebooks
+        subdims = self._get_subdims()
+        self._codebook = np.zeros([nSubspaces,self._nSubCodes,len(subdims[0])],
+                                  dtype=codewords.dtype)
+        for m in range(nSubspaces):
+            rows = np.random.permutation(nCodes)[:self._nSubCodes]
+            self._codebook[m] = codewords[rows][:,subdims[m]]
+        self._set_default_attributes()
+
+    def _get_subdims(self):
+        """
+        Returns the pattern dimensions of every block, one array per
+        block. A pattern is a flattened 12 x pSize matrix, a block is
+        made of consecutive beats (columns).
+        """
+        pSize = self._codesize / 12
+        blocksize = pSize / self._nSubspaces
+        dims = np.arange(self._codesize).reshape(12,pSize)
+        return [dims[:,m*blocksize:(m+1)*blocksize].flatten()
+                for m in range(self._nSubspaces)]
+
+    def _distance_tables(self,feats):
+        """
+        Asymmetric distance tables: SQUARED distances between the
+        (not quantized) patterns and every subcode, one table
+        nPatterns x nSubCodes per block.
+        The distance from a pattern to any code is the sum, over the
+        blocks, of the table entries of its subcodes.
+        """
+        cbnorms = self._get_cbnorms()
+        tables = []
+        for m,dims in enumerate(self._get_subdims()):
+            sub = feats[:,dims]
+            t = np.dot(sub,self._codebook[m].T) * -2.
+            t += cbnorms[m]
+            t += np.square(sub).sum(axis=1)[:,np.newaxis]
+            tables.append(t)
+        return tables
+
+    def _encode(self,feats):
+        """
+        Returns the subcodes of every pattern, nPatterns x nSubspaces,
+        and the SQUARED distances to the full code.
+        The distance is a sum over blocks, so the closest code is made
+        of the closest subcode of every block.
+        """
+        subcodes = np.zeros([feats.shape[0],self._nSubspaces],dtype='int32')
+        sqdists = np.zeros(feats.shape[0])
+        step = max(1,self._chunksize / self._nSubCodes / self._nSubspaces)
+        for start in range(0,feats.shape[0],step):
+            tables = self._distance_tables(feats[start:start+step])
+            for m,t in enumerate(tables):
+                best = np.argmin(t,axis=1)
+                subcodes[start:start+step,m] = best
+                sqdists[start:start+step] += t[np.arange(t.shape[0]),best]
+        # numerical errors can give tiny negative distances
+        sqdists[np.where(sqdists<0)] = 0
+        return subcodes,sqdists
+
+    def _combine_subcodes(self,subcodes):
+        """
+        Transforms subcodes (nPatterns x nSubspaces) into a code index,
+        first block being the least significant.
+        """
+        return combine_subcodes(subcodes,self._nSubCodes)
+
+    def update(self,feats,lrate=1e-5):
+        """
+        Receives a set of features (one pattern per line)
+        Do prediction on whole set.
+        Update every sub codebook (online VQ on each block), see Model.
+
+        Return avg_dist (mean squared distance per pixel)
+        """
+        feats = self._update_feats(feats)
+        subcodes,sqdists = self._encode(feats)
+        cbnorms = self._get_cbnorms()
+        for m,dims in enumerate(self._get_subdims()):
+            moved = update_codebook(self._codebook[m],feats[:,dims],
+                                    subcodes[:,m],lrate,mode=self._updatemode)
+            cbnorms[m,moved] = np.square(self._codebook[m,moved]).sum(axis=1)
+        # return mean dists
+        return np.average(sqdists * 1. / feats.shape[1])
+
+    def predicts(self,feats):
+        """
+        Returns two lists, best_code_per_pattern
+        and average squared distance, as Model.predicts()
+        Code index combines the subcodes, see _combine_subcodes()
+        """
+        assert feats.shape[1] > 0,'empty feats???'
+        feats = np.asarray(feats,dtype=self._codebook.dtype)
+        subcodes,sqdists = self._encode(feats)
+        avg_dists = sqdists * 1. / feats.shape[1]
+        assert not np.isnan(avg_dists).any(),'NaN in predicts'
+        return self._combine_subcodes(subcodes), avg_dists
+
+    def decode(self,codes):
+        """
+        Returns the patterns (one per row) corresponding to code indexes.
+        """
+        subcodes = split_codes(codes,self._nSubCodes,self._nSubspaces)
+        feats = np.zeros([len(codes),self._codesize],dtype=self._codebook.dtype)
+        for m,dims in enumerate(self._get_subdims()):
+            feats[:,dims] = self._codebook[m][subcodes[:,m]]
+        return feats
+
+
+class ModelRVQ(ModelStructured):
+    """
+    Residual VQ model. nStages small codebooks are applied one after
+    the other, each stage quantizing what the previous ones left (the
+    residual). A pattern is encoded by one subcode per stage, the
+    decoded pattern is the sum of the stage codewords.
+    With nSubCodes per stage we get nSubCodes^nStages codes, for a
+    search cost of nSubCodes x nStages distances (greedy search,
+    stage by stage).
+    The codebook is a 3D array: nStages x nSubCodes x code size
+    Codes indexes are built as in ModelPQ (first stage being the
+    least significant).
+    """
+
+    def __init__(self,codewords,nStages=2,chunksize=DEFAULT_CHUNKSIZE,
+                 updatemode='sequential'):
+        """
+        Constructor.
+        Needs an initialized codebook, one code per line, as for Model.
+        We use nCodes^(1/nStages) subcodes per stage (rounded).
+        First stage is initialized with random codewords, the next
+        ones with the residuals of other random codewords.
+        chunksize and updatemode: see Model
+        """
+        nCodes = codewords.shape[0]
+        self._codesize = codewords.shape[1]
+        self._nStages = nStages
+        self._nSubCodes = int(np.round(nCodes ** (1. / nStages)))
+        assert self._nSubCodes <= nCodes,'not enough codewords to initialize'
+        self._nCodes = self._nSubCodes ** nStages
+        if self._nCodes != nCodes:
+            print 'ModelRVQ: using',self._nCodes,'codes instead of',nCodes
+        self._chunksize = chunksize
+        self._updatemode = updatemode
+        self._codebook = np.zeros([nStages,self._nSubCodes,self._codesize],
+                                  dtype=codewords.dtype)
+        self._set_default_attributes()
+        # stage by stage, residuals of random codewords
+        residuals = np.array(codewords,dtype=codewords.dtype)
+        for s in range(nStages):
+            rows = np.random.permutation(nCodes)[:self._nSubCodes]
+            self._codebook[s] = residuals[rows]
+            self._cbnorms = None
+            codes = closest_codes_batch(self._codebook[s],residuals,
+                                        chunksize=chunksize)[0]
+            residuals -= self._codebook[s][codes]
+        self._cbnorms = None
+
+    def _encode(self,feats,keep_residuals=False):
+        """
+        Greedy search, stage by stage on the residuals.
+        Returns the subcodes of every pattern, nPatterns x nStages,
+        and the SQUARED distances to the decoded pattern (the norm of
+        the last residual, exact).
+        If keep_residuals, also returns the input of every stage,
+        nStages x nPatterns x code size.
+        """
+        cbnorms = self._get_cbnorms()
+        subcodes = np.zeros([feats.shape[0],self._nStages],dtype='int32')
+        residuals = np.array(feats)
+        inputs = None
+        if keep_residuals:
+            inputs = np.zeros([self._nStages] + list(feats.shape),
+                              dtype=feats.dtype)
+        for s in range(self._nStages):
+            if keep_residuals:
+                inputs[s] = residuals
+            codes = closest_codes_batch(self._codebook[s],residuals,
+                                        cbnorms=cbnorms[s],
+                                        chunksize=self._chunksize)[0]
+            subcodes[:,s] = codes
+            residuals -= self._codebook[s][codes]
+        sqdists = np.square(residuals).sum(axis=1)
+        if keep_residuals:
+            return subcodes,sqdists,inputs
+        return subcodes,sqdists
+
+    def update(self,feats,lrate=1e-5):
+        """
+        Receives a set of features (one pattern per line)
+        Do prediction on whole set.
+        Update every stage with the residuals it received (online VQ
+        on each stage), see Model.
+
+        Return avg_dist (mean squared distance per pixel)
+        """
+        feats = self._update_feats(feats)
+        subcodes,sqdists,inputs = self._encode(feats,keep_residuals=True)
+        cbnorms = self._get_cbnorms()
+        for s in range(self._nStages):
+            moved = update_codebook(self._codebook[s],inputs[s],
+                                    subcodes[:,s],lrate,mode=self._updatemode)
+            cbnorms[s,moved] = np.square(self._codebook[s,moved]).sum(axis=1)
+        # return mean dists
+        return np.average(sqdists * 1. / feats.shape[1])
+
+    def predicts(self,feats):
+        """
+        Returns two lists, best_code_per_pattern
+        and average squared distance, as Model.predicts()
+        Code index combines the subcodes, see combine_subcodes()
+        """
+        assert feats.shape[1] > 0,'empty feats???'
+        feats = np.asarray(feats,dtype=self._codebook.dtype)
+        subcodes,sqdists = self._encode(feats)
+        avg_dists = sqdists * 1. / feats.shape[1]
+        assert not np.isnan(avg_dists).any(),'NaN in predicts'
+        return combine_subcodes(subcodes,self._nSubCodes), avg_dists
+
+    def decode(self,codes):
+        """
+        Returns the patterns (one per row) corresponding to code indexes.
+        """
+        subcodes = split_codes(codes,self._nSubCodes,self._nStages)
+        feats = np.zeros([len(codes),self._codesize],dtype=self._codebook.dtype)
+        for s in range(self._nStages):
+            feats += self._codebook[s][subcodes[:,s]]
+        return feats
+
+
+class ModelTree(ModelStructured):
+    """
+    Tree-structured VQ. Codes are the leaves of a tree of depth D where
+    every node has 'branching' children, nCodes = branching^D.
+    A pattern goes down the tree, choosing the closest child at every
+    level: branching x D distances instead of nCodes.
+    Search is not exact, the leaf found is not always the closest one.
+    Level d (0 to D-1) has branching^(d+1) nodes, the children of node
+    i at level d are nodes i*branching to (i+1)*branching-1 at level
+    d+1. The last level, the leaves, is _codebook; inner levels are
+    in _levels.
+    Inner nodes start as the mean of the leaves below them, and are
+    learned online like the leaves, along the path of every pattern.
+    Growth: with growevery, we train only the first level at first,
+    one more level is added every growevery patterns, see grow().
+    """
+
+    def __init__(self,codewords,branching=2,chunksize=DEFAULT_CHUNKSIZE,
+                 updatemode='sequential',growevery=None):
+        """
+        Constructor.
+        Needs an initialized codebook, one code per line, as for Model.
+        We use the largest power of branching <= nCodes codewords,
+        ordered by splitting them recursively in branching groups of
+        the same size along their principal direction.
+        growevery: number of patterns before adding a level, None to
+                   train the full tree from the start
+        chunksize and updatemode: see Model
+        """
+        assert branching >= 2,'branching must be at least 2'
+        nCodes = codewords.shape[0]
+        self._branching = branching
+        self._depth = int(np.floor(np.log(nCodes) / np.log(branching) + 1e-9))
+        assert self._depth >= 1,'not enough codewords for one level'
+        self._nCodes = branching ** self._depth
+        if self._nCodes != nCodes:
+            print 'ModelTree: using',self._nCodes,'codes instead of',nCodes
+            rows = np.sort(np.random.permutation(nCodes)[:self._nCodes])
+            codewords = codewords[rows]
+        self._chunksize = chunksize
+        self._updatemode = updatemode
+        self._growevery = growevery
+        self._nPatternsSeen = 0
+        if growevery is None:
+            self._activeDepth = self._depth
+        else:
+            self._activeDepth = 1
+        # leaves, ordered so that siblings are consecutive
+        self._codebook = np.array(codewords[self._split_order(codewords)])
+        # inner nodes, mean of their leaves
+        codesize = self._codebook.shape[1]
+        self._levels = []
+        for d in range(self._depth - 1):
+            nNodes = branching ** (d + 1)
+            level = self._codebook.reshape(nNodes,-1,codesize).mean(axis=1)
+            self._levels.append(level.astype(self._codebook.dtype))
+        self._set_default_attributes()
+
+    def _split_order(self,codewords):
+        """
+        Order of the codewords for the leaves: split recursively in
+        branching groups of the same size, sorted by projection on
+        the principal direction of the group.
+        """
+        groups = [np.arange(codewords.shape[0])]
+        for d in range(self._depth):
+            newgroups = []
+            for g in groups:
+                x = codewords[g] - codewords[g].mean(axis=0)
+                direction = np.linalg.svd(x,full_matrices=False)[2][0]
+                g = g[np.argsort(np.dot(x,direction),kind='mergesort')]
+                newgroups.extend(np.split(g,self._branching))
+            groups = newgroups
+        return np.concatenate(groups)
+
+    def __setstate__(self,state):
+        """
+        For pickle. model_nonumpy.p has the inner levels as lists.
+        """
+        ModelStructured.__setstate__(self,state)
+        if len(self._levels) > 0 and type(self._levels[0]) == type([]):
+            self._levels = [np.array(l,dtype='float') for l in self._levels]
+
+    def _get_level(self,d):
+        """
+        Returns the nodes at level d, the leaves being the last level.
+        """
+        if d == self._depth - 1:
+            return self._codebook
+        return self._levels[d]
+
+    def _get_cbnorms(self):
+        """
+        Returns the squared norms of the nodes, one array per level.
+        """
+        if self._cbnorms is None:
+            self._cbnorms = [np.square(self._get_level(d)).sum(axis=1)
+                             for d in range(self._depth)]
+        return self._cbnorms
+
+    def _encode(self,feats):
+        """
+        Goes down the active levels of the tree.
+        Returns the path (one node index per pattern and per active
+        level, int32) and the SQUARED euclidean distances to the
+        last node of the path.
+        """
+        b = self._branching
+        nFeats = feats.shape[0]
+        path = np.zeros([nFeats,self._activeDepth],dtype='int32')
+        sqdists = np.zeros(nFeats)
+        cbnorms = self._get_cbnorms()
+        # patterns x children x code size floats at once
+        step = max(1,self._chunksize / (b * feats.shape[1]))
+        for start in range(0,nFeats,step):
+            x = feats[start:start+step]
+            rows = np.arange(x.shape[0])
+            node = np.zeros(x.shape[0],dtype='int32')
+            for d in range(self._activeDepth):
+                children = node[:,np.newaxis] * b + np.arange(b,dtype='int32')
+                # ||c||^2 - 2 x.c, enough to find the argmin
+                dots = np.einsum('ij,ikj->ik',x,self._get_level(d)[children])
+                dists = cbnorms[d][children] - 2. * dots
+                best = np.argmin(dists,axis=1)
+                node = children[rows,best]
+                path[start:start+step,d] = node
+            sqdists[start:start+step] = dists[rows,best] + np.square(x).sum(axis=1)
+        # numerical errors can give tiny negative distances
+        sqdists[np.where(sqdists<0)] = 0
+        return path,sqdists
+
+    def _leaf_codes(self,path):
+        """
+        Code index from a path: the last node if the tree is fully
+        grown, otherwise the first leaf under the last node.
+        """
+        shift = self._branching ** (self._depth - self._activeDepth)
+        return (path[:,-1] * shift).astype('int32')
+
+    def grow(self):
+        """
+        Adds one level to the trained tree. The new nodes keep the
+        shape of the initial split, each group of siblings is moved
+        so its mean is on the (trained) parent.
+        """
+        assert self._activeDepth < self._depth,'tree fully grown'
+        d = self._activeDepth
+        parents = self._get_level(d - 1)
+        children = self._get_level(d)
+        grouped = children.reshape(parents.shape[0],self._branching,-1)
+        grouped += (parents - grouped.mean(axis=1))[:,np.newaxis,:]
+        self._activeDepth += 1
+        self._cbnorms = None
+
+    def grow_on_schedule(self):
+        """
+        Adds the levels due after _nPatternsSeen patterns, one every
+        growevery patterns. Nothing to do without growevery.
+        """
+        if self._growevery is None:
+            return
+        while (self._activeDepth < self._depth and
+               self._nPatternsSeen >= self._growevery * self._activeDepth):
+            self.grow()
+
+    def update(self,feats,lrate=1e-5):
+        """
+        Receives a set of features (one pattern per line)
+        Do prediction on whole set.
+        Update every node on the path of each pattern (online VQ
+        at every level), see Model.
+        Grows the tree according to growevery.
+
+        Return avg_dist (mean squared distance per pixel)
+        """
+        feats = self._update_feats(feats)
+        path,sqdists = self._encode(feats)
+        cbnorms = self._get_cbnorms()
+        for d in range(path.shape[1]):
+            level = self._get_level(d)
+            moved = update_codebook(level,feats,path[:,d],lrate,
+                                    mode=self._updatemode)
+            cbnorms[d][moved] = np.square(level[moved]).sum(axis=1)
+        # growth schedule
+        self._nPatternsSeen += feats.shape[0]
+        self.grow_on_schedule()
+        # return mean dists
+        return np.average(sqdists * 1. / feats.shape[1])
+
+    def predicts(self,feats):
+        """
+        Returns two lists, best_code_per_pattern
+        and average squared distance, as Model.predicts()
+        """
+        assert feats.shape[1] > 0,'empty feats???'
+        feats = np.asarray(feats,dtype=self._codebook.dtype)
+        path,sqdists = self._encode(feats)
+        avg_dists = sqdists * 1. / feats.shape[1]
+        assert not np.isnan(avg_dists).any(),'NaN in predicts'
+        return self._leaf_codes(path), avg_dists
+
+
+
+def _predicts_shard(bounds):
+    """
+    Worker for predicts_parallel(), predicts on rows start to end
+    of the shared patterns.
+    """
+    start,end = bounds
+    return _shared_model.predicts(_shared_feats[start:end])
+
+def predicts_parallel(model,feats,nProcs=None,nShards=None):
+    """
+    Same as model.predicts(feats), but the patterns are cut in nShards
+    blocks of rows predicted by a pool of nProcs processes (default:
+    number of cpus).
+    Model and patterns are not sent to the workers, they inherit them
+    when the pool is forked (copy-on-write, read-only), only the row
+    ranges and the results go through pipes.
+    Search caches (norms, kd-tree) are built before forking so the
+    workers do not each rebuild them.
+    Returns best_code_per_pattern and average squared distance,
+    in the order of the patterns.
+    """
+    global _shared_model, _shared_feats
+    if nProcs is None:
+        nProcs = multiprocessing.cpu_count()
+    nFeats = feats.shape[0]
+    if nProcs <= 1 or nFeats < 2 * nProcs:
+        return model.predicts(feats)
+    if nShards is None:
+        nShards = nProcs * 4
+    nShards = min(nShards,nFeats)
+    bounds = np.linspace(0,nFeats,nShards+1).astype('int64')
+    # warm up caches in the parent
+    feats = np.asarray(feats,dtype=model._codebook.dtype)
+    if hasattr(model,'_get_backend'):
+        model._get_backend(bounds[1])
+    if hasattr(model,'_get_cbnorms'):
+        model._get_cbnorms()
+    _shared_model = model
+    _shared_feats = feats
+    pool = multiprocessing.Pool(processes=nProcs)
+    try:
+        try:
+            res = pool.map(_predicts_shard,zip(bounds[:-1],bounds[1:]))
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+    finally:
+        pool.join()
+        _shared_model = None
+        _shared_feats = None
+    codes = np.concatenate([r[0] for r in res])
+    dists = np.concatenate([r[1] for r in res])
+    return codes, dists
+
+class PredictStats:
+    """
+    Running aggregates over predictions done chunk by chunk,
+    see predicts_stream(): number of patterns, mean distortion
+    and number of patterns per code.
+    """
+
+    def __init__(self):
+        """
+        Constructor, nothing seen yet.
+        """
+        self.nPatterns = 0
+        self.sumDists = 0.
+        # grows with the largest code seen, codes of PQ models can
+        # go far above what we actually see
+        self.codeCounts = np.zeros(0,dtype='int64')
+
+    def add(self,codes,dists):
+        """
+        Adds the result of one predicts(): codes and average
+        squared distances.
+        """
+        self.nPatterns += len(codes)
+        self.sumDists += np.sum(dists)
+        if len(codes) == 0:
+            return
+        counts = np.bincount(codes)
+        if len(counts) > len(self.codeCounts):
+            counts[:len(self.codeCounts)] += self.codeCounts
+            self.codeCounts = counts.astype('int64')
+        else:
+            self.codeCounts[:len(counts)] += counts
+
+    def avg_dist(self):
+        """
+        Mean of the average squared distances, over all patterns.
+        """
+        if self.nPatterns == 0:
+            return np.nan
+        return self.sumDists / self.nPatterns
+
+    def nCodesUsed(self):
+        """
+        Number of codes that got at least one pattern.
+        """
+        return int(np.sum(self.codeCounts > 0))
+
+
+def predicts_stream(model,chunks,stats=None,skipempty=True):
+    """
+    Generator version of model.predicts(): receives an iterator of
+    pattern chunks (e.g. OracleMatfiles with oneFullIter=True, one
+    chunk per track) and yields (codes, avg dists) chunk by chunk,
+    the corpus is never in memory.
+    None chunks (tracks without features) are skipped, so are empty
+    patterns if skipempty.
+    stats, a PredictStats, is updated with every chunk.
+    """
+    for feats in chunks:
+        if feats is None:
+            continue
+        if skipempty:
+            feats = feats[np.where(np.sum(feats,axis=1)>0)]
+        if feats.shape[0] == 0:
+            continue
+        codes,dists = model.predicts(feats)
+        if stats is not None:
+            stats.add(codes,dists)
+        yield codes,dists
+
+
+def combine_subcodes(subcodes,nSubCodes):
+    """
+    Transforms subcodes (nPatterns x nParts, each part having nSubCodes
+    subcodes) into a code index, first part being the least significant.
+    Codes are int32, or int64 if there are too many.
+    """
+    nParts = subcodes.shape[1]
+    dtype = 'int32'
+    if nSubCodes ** nParts >= 2**31:
+        dtype = 'int64'
+    codes = np.zeros(subcodes.shape[0],dtype=dtype)
+    for m in range(nParts - 1,-1,-1):
+        codes *= nSubCodes
+        codes += subcodes[:,m]
+    return codes
+
+def split_codes(codes,nSubCodes,nParts):
+    """
+    Inverse of combine_subcodes(), returns nPatterns x nParts subcodes.
+    """
+    codes = np.array(codes,dtype='int64')
+    subcodes = np.zeros([len(codes),nParts],dtype='int32')
+    for m in range(nParts):
+        subcodes[:,m] = codes % nSubCodes
+        codes = codes / nSubCodes
+    return subcodes
+
+def roll_patterns(feats,rolls):
+    """
+    Rotates every pattern (flattened 12 x pSize, one per row) along the
+    chroma axis, pattern k by rolls[k], as np.roll(.,rolls[k],axis=0).
+    """
+    nFeats = feats.shape[0]
+    pSize = feats.shape[1] / 12
+    rows = (np.arange(12)[np.newaxis,:] - np.asarray(rolls)[:,np.newaxis]) % 12
+    rolled = feats.reshape(nFeats,12,pSize)[np.arange(nFeats)[:,np.newaxis],rows]
+    return rolled.reshape(nFeats,12*pSize)
 
 def euclidean_dist(a,b):
     """
@@ -251,6 +1421,86 @@ def euclidean_dist_batch(a,b):
     """
     return np.sqrt(np.square(a-b).sum(axis=1))
 
+def closest_codes_batch(codebook,feats,cbnorms=None,
+                        chunksize=DEFAULT_CHUNKSIZE,rerank=0):
+    """
+    Finds the closest code for every pattern (one per row in feats).
+    Squared distances are computed as ||x||^2 - 2 x.c + ||c||^2,
+    the dot products being done by BLAS on blocks of patterns.
+    cbnorms, the squared norm of each code, can be cached by the caller.
+    chunksize is the max number of pattern / code distances held
+    in memory at once.
+    If rerank > 1, that many best codes are compared again in float64
+    with the direct formula, it removes rounding errors when working
+    in float32.
+    Returns the indexes of the closest codes (int32)
+    and SQUARED euclidean distances
+    """
+    if cbnorms is None:
+        cbnorms = np.square(codebook).sum(axis=1)
+    nFeats = feats.shape[0]
+    best_codes = np.zeros(nFeats,dtype='int32')
+    sqdists = np.zeros(nFeats)
+    step = max(1,chunksize / codebook.shape[0])
+    for start in range(0,nFeats,step):
+        x = feats[start:start+step]
+        # ||c||^2 - 2 x.c, enough to find the argmin
+        d = np.dot(x,codebook.T)
+        d *= -2.
+        d += cbnorms
+        if rerank > 1 and rerank < codebook.shape[0]:
+            cands = np.argpartition(d,rerank-1,axis=1)[:,:rerank]
+            diffs = codebook[cands].astype('float64')
+            diffs -= x.astype('float64')[:,np.newaxis,:]
+            exact = np.square(diffs).sum(axis=2)
+            best = np.argmin(exact,axis=1)
+            best_codes[start:start+step] = cands[np.arange(x.shape[0]),best]
+            sqdists[start:start+step] = exact[np.arange(x.shape[0]),best]
+            continue
+        best = np.argmin(d,axis=1)
+        best_codes[start:start+step] = best
+        sqdists[start:start+step] = d[np.arange(x.shape[0]),best] + np.square(x).sum(axis=1)
+    # numerical errors can give tiny negative distances
+    sqdists[np.where(sqdists<0)] = 0
+    return best_codes, sqdists
+
+def update_codebook(codebook,feats,codes,lrate,mode='sequential'):
+    """
+    Moves the codes toward the patterns assigned to them, in place.
+    codes[k] is the index of the code for pattern feats[k].
+    Done with one grouped sum per code instead of a loop over patterns.
+    Two modes:
+      'sequential'   same result as moving the code once per pattern,
+                     in order, i.e. for a code hit n times:
+                     c = (1-lrate)^n c + lrate sum_i (1-lrate)^(n-i) x_i
+      'minibatch'    every pattern pulls the code from its old position:
+                     c = c + lrate sum_i (x_i - c)
+    Both are identical if each code is hit at most once.
+    Returns the indexes of the codes that moved.
+    """
+    if len(codes) == 0:
+        return np.zeros(0,dtype='int32')
+    # group patterns per code, keep their order within a code
+    order = np.argsort(codes,kind='mergesort')
+    sorted_codes = codes[order]
+    starts = np.concatenate([[0],np.where(np.diff(sorted_codes))[0]+1])
+    counts = np.diff(np.concatenate([starts,[len(codes)]]))
+    moved = sorted_codes[starts]
+    if mode == 'sequential':
+        # weight of each pattern depends on how many come after it
+        ranks = np.arange(len(codes)) - np.repeat(starts,counts)
+        powers = np.repeat(counts,counts) - 1 - ranks
+        weights = lrate * np.power(1. - lrate,powers)
+        sums = np.add.reduceat(feats[order] * weights[:,np.newaxis],starts,axis=0)
+        decay = np.power(1. - lrate,counts)
+        codebook[moved] = codebook[moved] * decay[:,np.newaxis] + sums
+    elif mode == 'minibatch':
+        sums = np.add.reduceat(feats[order],starts,axis=0)
+        codebook[moved] += (sums - codebook[moved] * counts[:,np.newaxis]) * lrate
+    else:
+        assert False,'wrong update mode: %s.'%mode
+    return moved
+
 def euclidean_norm(a):
     """ regular euclidean norm of a numpy vector """
     return np.sqrt(np.square(a).sum())
@@ -198,6 +198,8 @@ class OracleEN:
         self._do_resample = params['do_resample']
         self._partialbar = 0
         if params.has_key('partialbar'):self._partialbar = params['partialbar']
+        self._precision = 'float64'
+        if params.has_key('precision'):self._precision = params['precision']
         if params.has_key('randoffset'):
             assert not params['randoffset'],'randoffset not implemented for EN oracle'
         # start a number of EN threads
@@ -250,7 +252,8 @@ class OracleEN:
                                      positive=self._positive,
                                      do_resample=self._do_resample,
                                      partialbar=self._partialbar,
-                                     btchroma_barbts=None)
+                                     btchroma_barbts=None,
+                                     precision=self._precision)
 
     def tracksGiven(self):
         """
@@ -39,6 +39,8 @@ class OracleMatfiles:
         self._do_resample = params['do_resample']
         self._partialbar = 0
         if params.has_key('partialbar'):self._partialbar = params['partialbar']
+        self._precision = 'float64'
+        if params.has_key('precision'):self._precision = params['precision']
         # find all matfiles
         self._matfiles = get_all_matfiles(folder)
         assert len(self._matfiles) > 0,'no matfiles found in %s'%folder
@@ -82,7 +84,8 @@ class OracleMatfiles:
                                                   positive=self._positive,
                                                   do_resample=self._do_resample,
                                                   partialbar=self._partialbar,
-                                                  offset=offset)
+                                                  offset=offset,
+                                                  precision=self._precision)
         else:
             # we assume auto_bar contains a model
             # we predict on every offset until 4, return features with the best offset based on the model
@@ -91,18 +94,18 @@ class OracleMatfiles:
             realSize = self._pSize
             if self._partialbar > 0:
                 realSize = self._partialbar
-            # we go only until 4
-            for offset in range(min(realSize,4)):
-                # get features
-                feats = features.features_from_matfile(matfile,
-                                                       pSize=self._pSize,
-                                                       usebars=self._usebars,
-                                                       keyInv=self._keyInv,
-                                                       songKeyInv=self._songKeyInv,
-                                                       positive=self._positive,
-                                                       do_resample=self._do_resample,
-                                                       partialbar=self._partialbar,
-                                                       offset=offset)
+            # we go only until 4, file loaded once for all offsets
+            all_feats = features.features_from_matfile_offsets(matfile,
+                                                               range(min(realSize,4)),
+                                                               pSize=self._pSize,
+                                                               usebars=self._usebars,
+                                                               keyInv=self._keyInv,
+                                                               songKeyInv=self._songKeyInv,
+                                                               positive=self._positive,
+                                                               do_resample=self._do_resample,
+                                                               partialbar=self._partialbar,
+                                                               precision=self._precision)
+            for feats in all_feats:
                 if feats == None:
                     continue
                 # predicts
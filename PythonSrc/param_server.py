@@ -0,0 +1,412 @@
+"""
+Parameter server to train a model on several machines.
+
+The server owns the model, workers (one or more per machine) get
+tracks from their local oracle, update a local copy of the model on a
+minibatch of tracks, and send back the codes that moved (the deltas).
+The server adds the deltas to its codebook and answers with the full
+codebook every few minibatches, so workers follow the others.
+The server saves the experiment as trainer.train() does, same
+directory layout, so analyze_saved_model works on it.
+
+Everything goes through multiprocessing.connection (pickles over
+sockets, authenticated with a shared key). Unpickling runs code, so
+anyone with the key can run code on the server and the workers: the
+key is secret, there is no default one. Give it with -authkey or in
+the environment variable ONLINE_VQ_AUTHKEY (not visible in ps).
+Typical use:
+  export ONLINE_VQ_AUTHKEY=<secret>
+  server:  python trainer.py -server host:port [usual flags] codebook.mat
+  workers: python param_server.py -matdir <local data> host:port
+For testing, trainer.py -server localhost:port -nProcs n starts n
+workers on localhost.
+
+T. Bertin-Mahieux (2010) Columbia University
+tb2332@columbia.edu
+"""
+
+import os
+import sys
+import time
+import copy
+import threading
+import traceback
+import multiprocessing
+from multiprocessing.connection import Listener, Client
+import numpy as np
+
+import trainer as TRAINER
+
+AUTHKEY_ENV = 'ONLINE_VQ_AUTHKEY'
+
+
+def get_authkey(authkey=None):
+    """
+    Returns the shared key: authkey if given, otherwise the
+    environment variable ONLINE_VQ_AUTHKEY. There is no default key.
+    """
+    if authkey is None:
+        authkey = os.environ.get(AUTHKEY_ENV)
+    assert authkey,'no authkey, use -authkey or set %s'%AUTHKEY_ENV
+    return authkey
+
+
+def parse_address(address):
+    """
+    'host:port' -> (host, port)
+    """
+    host,port = address.rsplit(':',1)
+    return (host,int(port))
+
+
+def model_arrays(model):
+    """
+    Returns the arrays learned by the model, i.e. what moves:
+    the codebook (one code per row, PQ blocks are flattened)
+    and the inner levels of a tree.
+    """
+    arrays = [model._codebook.reshape(-1,model._codebook.shape[-1])]
+    if hasattr(model,'_levels'):
+        arrays.extend(model._levels)
+    return arrays
+
+
+def compute_deltas(model,before):
+    """
+    Difference between the arrays of the model and a copy of them
+    made before the updates (see model_arrays()).
+    Returns a list, one (idxs, delta) per array, only for rows
+    that moved.
+    """
+    deltas = []
+    for a,b in zip(model_arrays(model),before):
+        idxs = np.where(np.any(a != b,axis=1))[0]
+        deltas.append((idxs,a[idxs] - b[idxs]))
+    return deltas
+
+
+def set_model_arrays(model,arrays):
+    """
+    Replaces the arrays of the model (see model_arrays()) by the ones
+    received from the server, in place.
+    """
+    for a,b in zip(model_arrays(model),arrays):
+        a[:] = b
+    TRAINER.forget_search_caches(model)
+
+
+class ParamServer:
+    """
+    Server side: receives deltas from the workers, one thread per
+    worker, and saves the experiment regularly.
+    """
+
+    def __init__(self,model,params,expdir,statlog,global_iterations,
+                 address,authkey,broadcastevery=5):
+        """
+        Constructor, model / params / statlog as in trainer.train().
+        address is 'host:port' to listen to, authkey the shared key.
+        broadcastevery: send the codebook to a worker every that many
+        minibatches it sent us.
+        """
+        self._model = model
+        self._params = params
+        self._expdir = expdir
+        self._statlog = statlog
+        self._maxIterations = params['nIterations'] - global_iterations
+        self._address = parse_address(address)
+        self._authkey = authkey
+        self._broadcastevery = broadcastevery
+        self._lock = threading.Lock()
+        self._stop = False
+        self._nIterations = 0  # received from workers
+        self._nHandlers = 0
+        self._dist_estimate = []
+
+    def serve(self):
+        """
+        Accepts workers and saves regularly, until the workers did
+        nIterations or KeyboardInterrupt.
+        Returns the exit code, as trainer.train().
+        """
+        listener = Listener(self._address,authkey=self._authkey)
+        print 'parameter server listening on',self._address
+        acceptor = threading.Thread(target=self._accept,args=(listener,))
+        acceptor.setDaemon(True)
+        acceptor.start()
+        starttime = time.time()
+        last_save = starttime
+        last_printed_iter = 1
+        exit_code = 1
+        try:
+            while True:
+                time.sleep(1)
+                if self._nIterations >= int(np.ceil(last_printed_iter * 1.1)) and len(self._dist_estimate) > 0:
+                    print self._nIterations,'iterations, approx. avg dist:',np.average(self._dist_estimate)
+                    last_printed_iter = self._nIterations
+                if self._stop and self._nHandlers == 0:
+                    exit_code = 0 # normal exit
+                    break
+                if TRAINER.should_save(starttime,last_save):
+                    self._save(starttime)
+                    last_save = time.time()
+        except KeyboardInterrupt:
+            print ''
+            print 'Stoping after', self._nIterations, 'iterations.'
+        self._stop = True
+        listener.close()
+        print 'saving...'
+        savedir = self._save(starttime,crash=True)
+        print 'saved to: ',savedir
+        return exit_code
+
+    def _save(self,starttime,crash=False):
+        """
+        Saves the experiment, see trainer.save_experiment()
+        """
+        self._lock.acquire()
+        try:
+            return TRAINER.save_experiment(self._expdir,self._model,starttime,
+                                           self._statlog,self._params,
+                                           crash=crash)
+        finally:
+            self._lock.release()
+
+    def _accept(self,listener):
+        """
+        Accepts workers, one thread for each.
+        """
+        while not self._stop:
+            try:
+                conn = listener.accept()
+            except:
+                break # listener closed
+            self._lock.acquire()
+            self._nHandlers += 1
+            self._lock.release()
+            handler = threading.Thread(target=self._handle,args=(conn,))
+            handler.setDaemon(True)
+            handler.start()
+
+    def _handle(self,conn):
+        """
+        Talks to one worker.
+        Messages from the worker:
+          ('hello',)   answer ('init', params, model)
+          ('delta', deltas, nIterations, nPatterns, avg_dist, extra)
+                       answer ('stop',), ('ok',) or ('arrays', arrays)
+        """
+        try:
+            nDeltas = 0
+            while True:
+                msg = conn.recv()
+                if msg[0] == 'hello':
+                    self._lock.acquire()
+                    try:
+                        conn.send(('init',self._params,self._model))
+                    finally:
+                        self._lock.release()
+                    continue
+                assert msg[0] == 'delta','unknown message: %s.'%msg[0]
+                deltas,nIters,nPatterns,avg_dist,extra = msg[1:]
+                nDeltas += 1
+                self._lock.acquire()
+                try:
+                    self._apply(deltas,nIters,nPatterns,avg_dist,extra)
+                    if self._stop:
+                        conn.send(('stop',))
+                        break
+                    if nDeltas % self._broadcastevery == 0:
+                        conn.send(('arrays',model_arrays(self._model)))
+                    else:
+                        conn.send(('ok',))
+                finally:
+                    self._lock.release()
+        except (EOFError,IOError):
+            print 'lost a worker'
+        except:
+            traceback.print_exc()
+        conn.close()
+        self._lock.acquire()
+        self._nHandlers -= 1
+        self._lock.release()
+
+    def _apply(self,deltas,nIters,nPatterns,avg_dist,extra):
+        """
+        Adds the deltas of a worker to the model, updates the stats.
+        Called with the lock.
+        """
+        if hasattr(self._model,'_copy_on_write'):
+            self._model._copy_on_write() # saved snapshots share it
+        for a,(idxs,delta) in zip(model_arrays(self._model),deltas):
+            a[idxs] += delta
+        TRAINER.forget_search_caches(self._model)
+        # model state that is not in the arrays (tree growth)
+        for k in extra.keys():
+            setattr(self._model,k,max(getattr(self._model,k),extra[k]))
+        self._statlog.nIterations += nIters
+        self._statlog.nPatternUsed += nPatterns
+        self._nIterations += nIters
+        if nPatterns > 0:
+            self._dist_estimate.append(avg_dist)
+            if len(self._dist_estimate) > 200:
+                self._dist_estimate.pop(0)
+        if self._nIterations >= self._maxIterations:
+            self._stop = True
+
+
+def work(address,authkey,localparams={},minibatch=10):
+    """
+    Worker side: gets the params and the model from the server,
+    then loops over minibatches of tracks from a local oracle, and
+    sends the deltas to the server.
+    localparams overrides the server params for this machine
+    (e.g. matdir, artistsdb).
+    """
+    # forked workers get the same random state
+    np.random.seed((os.getpid() * 1000003 + int(time.time())) % 4294967296)
+    conn = Client(parse_address(address),authkey=authkey)
+    conn.send(('hello',))
+    msg = conn.recv()
+    assert msg[0] == 'init'
+    params,model = msg[1],msg[2]
+    params = copy.copy(params)
+    params.update(localparams)
+    TRAINER.set_worker_backend(model)
+    oracle = TRAINER.create_oracle(params)
+    lrate = params['lrate']
+    try:
+        while True:
+            before = [a.copy() for a in model_arrays(model)]
+            nPatterns = 0
+            dists = []
+            for k in range(minibatch):
+                if not params['autobar']:
+                    feats = oracle.next_track()
+                else:
+                    feats = oracle.next_track(auto_bar=model)
+                if feats == None:
+                    continue
+                feats = feats[np.nonzero(np.sum(feats,axis=1))]
+                if feats.shape[0] == 0:
+                    continue
+                assert not np.isnan(feats).any(),'features have NaN???'
+                nPatterns += feats.shape[0]
+                dists.append(model.update(feats,lrate=lrate))
+            avg_dist = 0.
+            if len(dists) > 0:
+                avg_dist = np.average(dists)
+            extra = {}
+            if hasattr(model,'_activeDepth'):
+                extra['_activeDepth'] = model._activeDepth
+            conn.send(('delta',compute_deltas(model,before),minibatch,
+                       nPatterns,avg_dist,extra))
+            msg = conn.recv()
+            if msg[0] == 'stop':
+                break
+            elif msg[0] == 'arrays':
+                set_model_arrays(model,msg[1])
+    except (EOFError,IOError):
+        print 'lost the server'
+    except KeyboardInterrupt:
+        pass
+    conn.close()
+    # EN oracle, try to stop/slow down threads
+    try:
+        TRAINER.oracle_en._en_queue_size = 0
+    except AttributeError:
+        pass
+
+
+def serve(model,params,expdir,statlog,global_iterations,address,authkey,
+          nLocalWorkers=0,broadcastevery=5):
+    """
+    Runs the parameter server, see ParamServer.
+    authkey is the shared key, see get_authkey().
+    If nLocalWorkers > 0, that many workers are started on this
+    machine (localhost mode, for testing).
+    Returns the exit code, as trainer.train().
+    """
+    server = ParamServer(model,params,expdir,statlog,global_iterations,
+                         address,authkey=authkey,
+                         broadcastevery=broadcastevery)
+    workers = []
+    if nLocalWorkers > 0:
+        # workers connect once the server listens
+        def delayed_work():
+            time.sleep(1)
+            work(address,authkey)
+        for k in range(nLocalWorkers):
+            p = multiprocessing.Process(target=delayed_work)
+            p.start()
+            workers.append(p)
+    exit_code = server.serve()
+    for p in workers:
+        p.join()
+    return exit_code
+
+
+def die_with_usage():
+    """
+    HELP MENU
+    """
+    print 'Worker for the parameter server, see trainer.py -server'
+    print 'usage:'
+    print '   python param_server.py [FLAGS] host:port'
+    print 'FLAGS:'
+    print ' -matdir d         matfiles directory on this machine'
+    print ' -artistsdb db     SQLlite database of artist names on this machine'
+    print ' -minibatch n      tracks per update sent to the server (default 10)'
+    print ' -authkey k        key shared with the server, default: environment'
+    print '                   variable '+AUTHKEY_ENV+' (no default key)'
+    print ' -nProcs n         launch n workers'
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+
+    # help menu
+    if len(sys.argv) < 2:
+        die_with_usage()
+
+    # flags
+    localparams = {}
+    minibatch = 10
+    authkey = None
+    nProcs = 1
+    while True:
+        if sys.argv[1] == '-matdir':
+            localparams['matdir'] = os.path.abspath(sys.argv[2])
+            sys.argv.pop(1)
+        elif sys.argv[1] == '-artistsdb':
+            localparams['artistsdb'] = sys.argv[2]
+            sys.argv.pop(1)
+        elif sys.argv[1] == '-minibatch':
+            minibatch = int(sys.argv[2])
+            sys.argv.pop(1)
+        elif sys.argv[1] == '-authkey':
+            authkey = sys.argv[2]
+            sys.argv.pop(1)
+        elif sys.argv[1] == '-nProcs':
+            nProcs = int(sys.argv[2])
+            sys.argv.pop(1)
+        else:
+            break
+        sys.argv.pop(1)
+    address = sys.argv[1]
+    authkey = get_authkey(authkey)
+
+    # launch workers
+    if nProcs == 1:
+        work(address,authkey,localparams=localparams,
+             minibatch=minibatch)
+    else:
+        workers = []
+        for k in range(nProcs):
+            p = multiprocessing.Process(target=work,args=(address,authkey),
+                                        kwargs={'localparams':localparams,
+                                                'minibatch':minibatch})
+            p.start()
+            workers.append(p)
+        for p in workers:
+            p.join()
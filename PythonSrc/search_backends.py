@@ -0,0 +1,824 @@
+"""
+Backends to find the closest codeword to a set of patterns,
+used by model.Model.
+
+A backend is built on a model and answers query(feats) with the
+indexes of the closest codes (int32) and SQUARED euclidean distances.
+Two kinds:
+  - static backends (kd-trees) are built on a copy of the codebook,
+    they do not follow the codes when they move. The model keeps
+    track of the codes that moved and rebuilds the backend when it
+    is too stale, see Model._closest_codes_index().
+  - dynamic backends always search the current codebook, they
+    are told which codes moved through codes_moved().
+
+Which libraries are installed differs between machines, calibrate()
+times the usable backends on the actual codebook and picks the
+fastest.
+
+T. Bertin-Mahieux (2010) Columbia University
+tb2332@columbia.edu
+"""
+
+import sys
+import time
+import numpy as np
+try:
+    import scipy.spatial
+    _ckdtree_imported = True
+except ImportError:
+    _ckdtree_imported = False
+# too hard to install for python 2.4 (I know, 2.4, pfff)
+try:
+    import scikits.ann as ann
+    _ann_imported = True
+except:
+    _ann_imported = False
+
+
+class SearchBackend:
+    """
+    Base class for the backends, see module documentation.
+    """
+    name = ''
+    static = False  # built on a copy of the codebook?
+    exact = True    # always returns the closest code?
+    approx = False  # uses the model approx (eps), see Model
+    rerank = False  # re-ranks in float64 with the model rerank
+    available = True
+    maxCodes = None # too expensive for larger codebooks
+
+    def __init__(self,model):
+        """
+        Constructor, receives the model whose codebook we search.
+        """
+        self._model = model
+
+    def query(self,feats):
+        """
+        Returns the indexes of the closest codes (int32)
+        and SQUARED euclidean distances
+        """
+        raise NotImplementedError
+
+    def codes_moved(self,idxs):
+        """
+        Called by the model when the codes in idxs have been modified.
+        """
+        pass
+
+
+class BruteBackend(SearchBackend):
+    """
+    Distances to all codes by blocks of patterns using matrix
+    products (BLAS), see model.closest_codes_batch().
+    """
+    name = 'brute'
+    rerank = True
+
+    def query(self,feats):
+        """
+        Returns the indexes of the closest codes (int32)
+        and SQUARED euclidean distances
+        """
+        return self._model._closest_codes_blas(feats)
+
+
+class CKDTreeBackend(SearchBackend):
+    """
+    Kd-tree from scipy.spatial.
+    Approximate if the model has approx > 0 (eps of the search).
+    """
+    name = 'ckdtree'
+    static = True
+    approx = True
+    available = _ckdtree_imported
+
+    def __init__(self,model):
+        """
+        Constructor, builds the tree on a copy of the codebook.
+        """
+        SearchBackend.__init__(self,model)
+        self.codebook = model._codebook.copy()
+        self._tree = scipy.spatial.cKDTree(self.codebook,leafsize=16)
+
+    def query(self,feats):
+        """
+        Returns the indexes of the closest codes (int32)
+        and SQUARED euclidean distances
+        """
+        dists,codes = self._tree.query(feats,k=1,eps=self._model._approx)
+        return codes.astype('int32'),np.square(dists)
+
+
+class AnnBackend(SearchBackend):
+    """
+    Kd-tree from scikits.ann.
+    Sometimes ann has numerical errors, distances are then NaN,
+    the model redoes those patterns.
+    Approximate if the model has approx > 0 (eps of the search).
+    """
+    name = 'ann'
+    static = True
+    approx = True
+    available = _ann_imported
+    eps = 0.
+
+    def __init__(self,model):
+        """
+        Constructor, builds the tree on a copy of the codebook.
+        """
+        SearchBackend.__init__(self,model)
+        self.codebook = model._codebook.copy()
+        self._tree = ann.kdtree(self.codebook)
+
+    def query(self,feats):
+        """
+        Returns the indexes of the closest codes (int32)
+        and SQUARED euclidean distances (ann gives them squared)
+        """
+        res = self._tree.knn(feats,1,eps=max(self.eps,self._model._approx))
+        return res[0].flatten().astype('int32'),res[1].flatten()
+
+
+class AnnApproxBackend(AnnBackend):
+    """
+    Kd-tree from scikits.ann, approximate search: the code returned
+    is at most (1+eps) times further than the closest one.
+    """
+    name = 'ann_approx'
+    exact = False
+    eps = .001
+
+
+class ElkanBackend(SearchBackend):
+    """
+    Exact search pruned with the triangle inequality (see Elkan,
+    ICML 2003, and codebook_speedtest.py).
+    We keep a lower bound on the distance between every pair of codes.
+    A pattern x is first compared to a few pivot codes, a being the
+    closest one and u = d(x,c_a). Then a code j with bound(a,j) >= 2u
+    can't be closer than a:
+        d(x,c_j) >= d(c_a,c_j) - d(x,c_a) >= u
+    so we compute distances only to the remaining candidates.
+    Bounds are computed exactly at creation, by blocks. Codes that
+    move add the distance to their cumulative drift; we store
+    d(c_a,c_j) + drift[a] + drift[j] (drifts when it was computed),
+    so bound(a,j) = stored - drift[a] - drift[j] with the current
+    drifts, computed only for the pivot rows used by a query.
+    A code that drifted too much gets its bounds recomputed.
+    Needs nCodes^2 floats, see maxCodes.
+    """
+    name = 'elkan'
+    maxCodes = 8192
+    tighten = .1   # recompute bounds of a code after it drifted that
+                   # fraction of the distance to its closest code
+
+    def __init__(self,model):
+        """
+        Constructor, computes the bounds.
+        """
+        SearchBackend.__init__(self,model)
+        codebook = model._codebook
+        nCodes = codebook.shape[0]
+        # positions when the drifts were last updated
+        self._positions = codebook.copy()
+        cbnorms = model._get_cbnorms()
+        self._bounds = np.zeros([nCodes,nCodes])
+        # distance of every code to its closest other code
+        closest = np.zeros(nCodes)
+        step = max(1,model._chunksize / nCodes)
+        for start in range(0,nCodes,step):
+            end = min(nCodes,start+step)
+            block = pairwise_distances(codebook[start:end],codebook,
+                                       cbnorms[start:end],cbnorms)
+            self._bounds[start:end] = block
+            block[np.arange(end-start),np.arange(start,end)] = np.inf
+            closest[start:end] = block.min(axis=1)
+        # cumulative drift, and drift when the bounds were recomputed
+        self._drift = np.zeros(nCodes)
+        self._rowdrift = np.zeros(nCodes)
+        # max drift before the bounds of a code are recomputed
+        self._maxdrift = closest * self.tighten
+        # pivots, spread over the codebook (farthest-first traversal)
+        nPivots = min(nCodes,int(np.ceil(np.sqrt(nCodes))))
+        pivots = [np.random.randint(nCodes)]
+        mindist = self._bounds[pivots[0]].copy()
+        for k in range(1,nPivots):
+            pivots.append(np.argmax(mindist))
+            mindist = np.minimum(mindist,self._bounds[pivots[-1]])
+        self._pivots = np.sort(np.array(pivots))
+        # stats, number of pattern / code distances computed
+        self.nDistEvals = 0
+        self.nPatterns = 0
+
+    def query(self,feats):
+        """
+        Returns the indexes of the closest codes (int32)
+        and SQUARED euclidean distances
+        """
+        codebook = self._model._codebook
+        cbnorms = self._model._get_cbnorms()
+        featnorms = np.square(feats).sum(axis=1)
+        # closest pivot
+        pdists = np.dot(feats,codebook[self._pivots].T) * -2.
+        pdists += cbnorms[self._pivots]
+        pbest = np.argmin(pdists,axis=1)
+        best_codes = self._pivots[pbest].astype('int32')
+        sqdists = pdists[np.arange(feats.shape[0]),pbest] + featnorms
+        sqdists[np.where(sqdists<0)] = 0
+        self.nDistEvals += feats.shape[0] * len(self._pivots)
+        self.nPatterns += feats.shape[0]
+        # by group of patterns with the same pivot
+        pivot_per_p = best_codes.copy()
+        for a in np.unique(pivot_per_p):
+            group = np.where(pivot_per_p == a)[0]
+            u = np.sqrt(sqdists[group].max())
+            bounds = self._bounds[a] - self._drift[a] - self._drift
+            cands = np.where(bounds < 2. * u)[0]
+            if len(cands) == 0:
+                continue
+            d = np.dot(feats[group],codebook[cands].T) * -2.
+            d += cbnorms[cands]
+            d += featnorms[group][:,np.newaxis]
+            cbest = np.argmin(d,axis=1)
+            cdists = d[np.arange(len(group)),cbest]
+            better = np.where(cdists < sqdists[group])[0]
+            best_codes[group[better]] = cands[cbest[better]]
+            sqdists[group[better]] = np.maximum(cdists[better],0)
+            self.nDistEvals += len(group) * len(cands)
+        return best_codes,sqdists
+
+    def codes_moved(self,idxs):
+        """
+        Adds the distance moved to the drift of the codes, recomputes
+        the bounds of the codes that drifted too much.
+        """
+        if len(idxs) == 0:
+            return
+        codebook = self._model._codebook
+        moves = codebook[idxs] - self._positions[idxs]
+        delta = np.sqrt(np.square(moves).sum(axis=1))
+        self._positions[idxs] = codebook[idxs]
+        self._drift[idxs] += delta
+        # recompute bounds for codes that drifted too much
+        drifted = self._drift[idxs] - self._rowdrift[idxs]
+        redo = idxs[np.where(drifted > self._maxdrift[idxs])]
+        if len(redo) > 0:
+            cbnorms = self._model._get_cbnorms()
+            d = pairwise_distances(codebook[redo],codebook,
+                                   cbnorms[redo],cbnorms)
+            d += self._drift[redo][:,np.newaxis]
+            d += self._drift
+            self._bounds[redo,:] = d
+            self._bounds[:,redo] = d.T
+            self._rowdrift[redo] = self._drift[redo]
+
+
+class PDSBackend(SearchBackend):
+    """
+    Exact search by partial distances (PDS): the squared distance to
+    the codes is accumulated block by block (the chroma rows of the
+    12 x pSize pattern, contiguous in memory, the strongest ones
+    after key invariance), and a code is abandoned as soon as its
+    partial distance is larger than the best distance so far.
+    The leading blocks are done for all codes of a group with a
+    matrix product (BLAS), the next ones stepblocks at a time, only
+    for the patterns and codes that survived.
+    Codes are tried by groups, by decreasing number of hits (see
+    Model._get_code_order()), the first group exactly, so the best
+    distance is small early and most codes are abandoned after the
+    leading blocks. We keep a copy of the codebook in that order,
+    codes_moved() patches the rows of the codes that moved.
+    Useful for long patterns (16 or 32 beats).
+    """
+    name = 'pds'
+    groupsize = 256  # codes tried together
+    leadblocks = 1   # blocks (chroma rows) in the BLAS partial distance
+    stepblocks = 3   # blocks added at a time for the survivors
+    maxpatterns = 128 # patterns tried together, few survivors
+
+    def __init__(self,model):
+        """
+        Constructor, copies the codebook in the order of the hits.
+        """
+        SearchBackend.__init__(self,model)
+        nCodes,codesize = model._codebook.shape
+        self._nBlocks = 12
+        if codesize % self._nBlocks != 0:
+            self._nBlocks = 1
+        self._blocksize = codesize / self._nBlocks
+        self._lead = self._blocksize * min(self.leadblocks,self._nBlocks)
+        self._order = None
+        self._reorder(model._get_code_order())
+        # stats, number of pattern / code distances computed, partial
+        # (leading blocks) and complete
+        self.nPartialEvals = 0
+        self.nFullEvals = 0
+        self.nPatterns = 0
+
+    def _reorder(self,order):
+        """
+        Copies the codebook in the given order, with the squared
+        norms of the codes and of their leading blocks.
+        """
+        model = self._model
+        self._order = order
+        # position of every code in the copy
+        self._position = np.zeros(len(order),dtype='int32')
+        self._position[order] = np.arange(len(order),dtype='int32')
+        self._codebook = model._codebook[order]
+        self._cbnorms = model._get_cbnorms()[order]
+        self._cblead = np.square(self._codebook[:,:self._lead]).sum(axis=1)
+
+    def codes_moved(self,idxs):
+        """
+        Called by the model when the codes in idxs have been modified.
+        """
+        if len(idxs) == 0:
+            return
+        pos = self._position[idxs]
+        self._codebook[pos] = self._model._codebook[idxs]
+        self._cbnorms[pos] = np.square(self._codebook[pos]).sum(axis=1)
+        lead = self._codebook[pos,:self._lead]
+        self._cblead[pos] = np.square(lead).sum(axis=1)
+
+    def query(self,feats):
+        """
+        Returns the indexes of the closest codes (int32)
+        and SQUARED euclidean distances
+        """
+        model = self._model
+        order = model._get_code_order()
+        if order is not self._order:
+            self._reorder(order)
+        codebook = self._codebook
+        cbnorms = self._cbnorms
+        cblead = self._cblead
+        nCodes,codesize = codebook.shape
+        lead = self._lead
+        bsize = self._blocksize * self.stepblocks
+        nFeats = feats.shape[0]
+        featnorms = np.square(feats).sum(axis=1)
+        featlead = np.square(feats[:,:lead]).sum(axis=1)
+        # rounding errors of the partial distances
+        tol = np.finfo(feats.dtype).eps * codesize * (featnorms + 1.)
+        # most used codes first, no pruning
+        first = min(self.groupsize,nCodes)
+        d = np.dot(feats,codebook[:first].T) * -2.
+        d += cbnorms[:first]
+        codes = np.argmin(d,axis=1)
+        best_codes = order[codes].astype('int32')
+        sqdists = d[np.arange(nFeats),codes] + featnorms
+        sqdists[np.where(sqdists<0)] = 0
+        self.nFullEvals += nFeats * first
+        self.nPatterns += nFeats
+        # then by groups of codes, by chunk of patterns
+        step = max(1,min(self.maxpatterns,model._chunksize / self.groupsize))
+        for pstart in range(0,nFeats,step):
+            x = feats[pstart:pstart+step]
+            pend = pstart + x.shape[0]
+            best = sqdists[pstart:pend]  # view, updated in place
+            bestc = best_codes[pstart:pend]
+            xtol = tol[pstart:pend]
+            for cstart in range(first,nCodes,self.groupsize):
+                cend = min(nCodes,cstart+self.groupsize)
+                # partial distances on the leading blocks
+                partial = np.dot(x[:,:lead],codebook[cstart:cend,:lead].T)
+                partial *= -2.
+                partial += cblead[cstart:cend]
+                partial += featlead[pstart:pend][:,np.newaxis]
+                self.nPartialEvals += partial.size
+                alive = partial < (best + xtol)[:,np.newaxis]
+                pp,kk = np.nonzero(alive)
+                d = partial[pp,kk]
+                kk += cstart
+                # next blocks for the survivors, abandoned when the
+                # partial distance exceeds the best one
+                for bstart in range(lead,codesize,bsize):
+                    if len(pp) == 0:
+                        break
+                    diff = x[pp,bstart:bstart+bsize]
+                    diff -= codebook[kk,bstart:bstart+bsize]
+                    d += np.einsum('ij,ij->i',diff,diff)
+                    self.nPartialEvals += len(pp)
+                    keep = np.where(d < best[pp] + xtol[pp])[0]
+                    pp,kk,d = pp[keep],kk[keep],d[keep]
+                if len(pp) == 0:
+                    continue
+                self.nFullEvals += len(pp)
+                # best survivor per pattern (pp is sorted)
+                srt = np.lexsort((d,pp))
+                starts = np.where(np.diff(pp[srt]))[0] + 1
+                firsts = srt[np.concatenate([[0],starts])]
+                pp = pp[firsts]
+                d = d[firsts]
+                better = np.where(d < best[pp])[0]
+                best[pp[better]] = np.maximum(d[better],0)
+                bestc[pp[better]] = order[kk[firsts][better]]
+        return best_codes,sqdists
+
+
+class PCABackend(SearchBackend):
+    """
+    Search in a small PCA space, then exact re-rank.
+    Patterns and codes are projected on the nComponents principal
+    directions of the codebook, we shortlist the closest codes there
+    and compute exact distances to them only.
+    Projected distances are lower bounds of the real ones (orthonormal
+    projection), so if the best exact distance on the shortlist is
+    below the next projected distance, no other code can be closer;
+    the few patterns where we can't tell are redone by brute force.
+    Results are exact.
+    Moved codes are projected again right away, the directions are
+    refit lazily, when many codes moved since the last fit.
+    """
+    name = 'pca'
+    nComponents = 16
+    shortlist = 32
+    refit = 1.  # refit after that many moves per code, on average
+
+    def __init__(self,model):
+        """
+        Constructor, fits the projection.
+        """
+        SearchBackend.__init__(self,model)
+        self._fit()
+        # stats, number of patterns redone by brute force
+        self.nRedone = 0
+        self.nPatterns = 0
+
+    def _fit(self):
+        """
+        Principal directions of the current codebook, projected codes.
+        """
+        codebook = self._model._codebook
+        self._mean = codebook.mean(axis=0)
+        r = min(self.nComponents,codebook.shape[0],codebook.shape[1])
+        vt = np.linalg.svd(codebook - self._mean,full_matrices=False)[2]
+        self._directions = vt[:r].T.astype(codebook.dtype)
+        self._projected = np.dot(codebook - self._mean,self._directions)
+        self._projnorms = np.square(self._projected).sum(axis=1)
+        self._nMoved = 0
+
+    def query(self,feats):
+        """
+        Returns the indexes of the closest codes (int32)
+        and SQUARED euclidean distances
+        """
+        model = self._model
+        codebook = model._codebook
+        nCodes = codebook.shape[0]
+        if self._nMoved > self.refit * nCodes:
+            self._fit()
+        nFeats = feats.shape[0]
+        m = min(self.shortlist,nCodes)
+        best_codes = np.zeros(nFeats,dtype='int32')
+        sqdists = np.zeros(nFeats)
+        redo = np.zeros(nFeats,dtype='bool')
+        # relative rounding errors, see the redo test
+        slack = 4. * np.finfo(codebook.dtype).eps * codebook.shape[1]
+        step = max(1,model._chunksize / max(nCodes,m * feats.shape[1]))
+        for start in range(0,nFeats,step):
+            x = feats[start:start+step]
+            rows = np.arange(x.shape[0])
+            # projected distances, up to ||px||^2
+            px = np.dot(x - self._mean,self._directions)
+            d = np.dot(px,self._projected.T) * -2.
+            d += self._projnorms
+            if m < nCodes:
+                part = np.argpartition(d,m,axis=1)
+                cands = part[:,:m]
+                # smallest projected distance outside the shortlist
+                pxnorms = np.square(px).sum(axis=1)
+                nextd = d[rows,part[:,m]] + pxnorms
+                # lower bound, with the rounding errors of the
+                # products, relative to the norms
+                nextd -= (pxnorms + self._projnorms[part[:,m]]) * slack
+            else:
+                cands = np.tile(np.arange(nCodes),(x.shape[0],1))
+                nextd = np.inf
+            # exact re-rank
+            diffs = codebook[cands] - x[:,np.newaxis,:]
+            exact = np.square(diffs).sum(axis=2)
+            best = np.argmin(exact,axis=1)
+            best_codes[start:start+step] = cands[rows,best]
+            sqdists[start:start+step] = exact[rows,best]
+            # the exact distances have rounding errors too
+            redo[start:start+step] = exact[rows,best] * (1. + slack) > nextd
+        # patterns we can't certify
+        redo = np.where(redo)[0]
+        if len(redo) > 0:
+            codes,dists = model._closest_codes_blas(feats[redo])
+            best_codes[redo] = codes
+            sqdists[redo] = dists
+        self.nRedone += len(redo)
+        self.nPatterns += nFeats
+        return best_codes,sqdists
+
+    def codes_moved(self,idxs):
+        """
+        Projects the codes that moved, counts the moves for the refit.
+        """
+        if len(idxs) == 0:
+            return
+        proj = np.dot(self._model._codebook[idxs] - self._mean,
+                      self._directions)
+        self._projected[idxs] = proj
+        self._projnorms[idxs] = np.square(proj).sum(axis=1)
+        self._nMoved += len(idxs)
+
+
+class LSHBackend(SearchBackend):
+    """
+    Locality-sensitive hashing with random hyperplanes (sign of random
+    projections, Charikar 2002). Each of nTables tables hashes a code
+    to nBits bits. A pattern looks in its bucket of every table, and
+    also in the buckets where the bits it is least sure of are flipped
+    (multi-probe, Lv et al. 2007). The candidates are then compared
+    exactly. Patterns without candidates are done by brute force.
+    Search is approximate, the closest code can be in no probed bucket.
+    A table is the codes sorted by key, a bucket is a range found by
+    binary search, so everything is done with numpy arrays.
+    Moved codes are hashed again, see codes_moved().
+    """
+    name = 'lsh'
+    exact = False
+    nTables = 4
+    nProbes = 4     # buckets per table: own + flips of the weakest bits
+    bucketsize = 8  # average codes per bucket, sets nBits
+
+    def __init__(self,model):
+        """
+        Constructor, draws the hyperplanes and hashes the codebook.
+        """
+        SearchBackend.__init__(self,model)
+        codebook = model._codebook
+        nCodes = codebook.shape[0]
+        nBits = np.round(np.log2(nCodes * 1. / self.bucketsize))
+        self._nBits = int(max(1,nBits))
+        self._nBits = min(self._nBits,30)
+        # hyperplanes through the center of the codebook
+        self._mean = codebook.mean(axis=0)
+        self._planes = np.random.randn(codebook.shape[1],
+                                       self.nTables * self._nBits)
+        self._planes = self._planes.astype(codebook.dtype)
+        self._powers = 2 ** np.arange(self._nBits)
+        # codes keys (nCodes x nTables), and for every table the codes
+        # sorted by key with the sorted keys
+        self._keys = self._hash(codebook)[0]
+        self._order = [None] * self.nTables
+        self._sorted = [None] * self.nTables
+        for t in range(self.nTables):
+            self._sort_table(t)
+        # stats, number of candidates compared, patterns done brute force
+        self.nCandidates = 0
+        self.nBrute = 0
+        self.nPatterns = 0
+
+    def _hash(self,x):
+        """
+        Returns the keys (one per table, int64) and the projections.
+        """
+        proj = np.dot(x - self._mean,self._planes)
+        proj = proj.reshape(x.shape[0],self.nTables,self._nBits)
+        keys = np.dot(proj > 0,self._powers).astype('int64')
+        return keys,proj
+
+    def _sort_table(self,t):
+        """
+        Sorts the codes by key in table t.
+        """
+        self._order[t] = np.argsort(self._keys[:,t],kind='mergesort')
+        self._sorted[t] = self._keys[self._order[t],t]
+
+    def _rehash_in_table(self,t,codes):
+        """
+        The codes changed bucket in table t (self._keys is up to date):
+        they are removed from the sorted table and inserted at their
+        new place found by binary search, no sort of the whole table.
+        """
+        out = np.zeros(self._keys.shape[0],dtype='bool')
+        out[codes] = True
+        keep = np.where(np.logical_not(out[self._order[t]]))[0]
+        order = self._order[t][keep]
+        keys = self._sorted[t][keep]
+        codes = codes[np.argsort(self._keys[codes,t],kind='mergesort')]
+        newkeys = self._keys[codes,t]
+        pos = np.searchsorted(keys,newkeys,side='right')
+        self._order[t] = np.insert(order,pos,codes)
+        self._sorted[t] = np.insert(keys,pos,newkeys)
+
+    def _candidates(self,keys,proj):
+        """
+        Pattern / code pairs found in the probed buckets, unique,
+        sorted by pattern.
+        """
+        nFeats = keys.shape[0]
+        nCodes = self._keys.shape[0]
+        # bits to flip: smallest projections, one flip per probe
+        nFlips = min(self.nProbes - 1,self._nBits)
+        weakest = np.argsort(np.abs(proj),axis=2)[:,:,:nFlips]
+        probes = np.concatenate([keys[:,:,np.newaxis],
+                                 keys[:,:,np.newaxis] ^ self._powers[weakest]],
+                                axis=2)
+        pairs = []
+        for t in range(self.nTables):
+            q = probes[:,t,:].ravel()
+            lo = np.searchsorted(self._sorted[t],q,side='left')
+            hi = np.searchsorted(self._sorted[t],q,side='right')
+            counts = hi - lo
+            total = np.sum(counts)
+            if total == 0:
+                continue
+            pp = np.repeat(np.arange(len(q)) / probes.shape[2],counts)
+            firsts = np.cumsum(counts) - counts
+            offsets = np.arange(total) - np.repeat(firsts,counts)
+            kk = self._order[t][np.repeat(lo,counts) + offsets]
+            pairs.append(pp.astype('int64') * nCodes + kk)
+        if len(pairs) == 0:
+            return np.zeros(0,dtype='int64'),np.zeros(0,dtype='int64')
+        pairs = np.unique(np.concatenate(pairs))
+        return pairs / nCodes, pairs % nCodes
+
+    def query(self,feats):
+        """
+        Returns the indexes of the closest codes (int32)
+        and SQUARED euclidean distances
+        """
+        model = self._model
+        codebook = model._codebook
+        nFeats = feats.shape[0]
+        keys,proj = self._hash(feats)
+        pp,kk = self._candidates(keys,proj)
+        # exact distances to the candidates, by chunks
+        dists = np.zeros(len(pp))
+        step = max(1,model._chunksize / feats.shape[1])
+        for start in range(0,len(pp),step):
+            # take() is much faster than fancy indexing
+            diff = feats.take(pp[start:start+step],axis=0)
+            diff -= codebook.take(kk[start:start+step],axis=0)
+            dists[start:start+step] = np.einsum('ij,ij->i',diff,diff)
+        best_codes = np.zeros(nFeats,dtype='int32')
+        sqdists = np.zeros(nFeats)
+        if len(pp) > 0:
+            # best candidate per pattern, pp is sorted
+            starts = np.concatenate([[0],np.where(np.diff(pp))[0]+1])
+            counts = np.diff(np.concatenate([starts,[len(pp)]]))
+            mins = np.minimum.reduceat(dists,starts)
+            ismin = np.where(dists == np.repeat(mins,counts))[0]
+            # first minimum of each pattern
+            ismin = ismin[np.concatenate([[True],np.diff(pp[ismin]) > 0])]
+            best_codes[pp[ismin]] = kk[ismin]
+            sqdists[pp[ismin]] = dists[ismin]
+        # patterns without candidates
+        brute = np.setdiff1d(np.arange(nFeats),pp)
+        if len(brute) > 0:
+            codes,d = model._closest_codes_blas(feats[brute])
+            best_codes[brute] = codes
+            sqdists[brute] = d
+        self.nCandidates += len(pp)
+        self.nBrute += len(brute)
+        self.nPatterns += nFeats
+        return best_codes,sqdists
+
+    def codes_moved(self,idxs):
+        """
+        Hashes again the codes that moved, the ones that crossed a
+        hyperplane move to their new bucket, see _rehash_in_table().
+        """
+        if len(idxs) == 0:
+            return
+        idxs = np.unique(idxs)
+        newkeys = self._hash(self._model._codebook[idxs])[0]
+        changed = newkeys != self._keys[idxs]
+        self._keys[idxs] = newkeys
+        for t in np.where(np.any(changed,axis=0))[0]:
+            self._rehash_in_table(t,idxs[changed[:,t]])
+
+
+def pairwise_distances(a,b,anorms=None,bnorms=None):
+    """
+    Euclidean distances between every row of a and every row of b,
+    using matrix products, anorms and bnorms being the squared norms
+    of the rows. Distances are made a little smaller to absorb the
+    rounding errors, they can be used as lower bounds.
+    Returns a matrix len(a) x len(b)
+    """
+    if anorms is None:
+        anorms = np.square(a).sum(axis=1)
+    if bnorms is None:
+        bnorms = np.square(b).sum(axis=1)
+    d = np.dot(a,b.T) * -2.
+    d += anorms[:,np.newaxis]
+    d += bnorms
+    # rounding errors are relative to the norms and to the
+    # resolution of the type (float32 or float64)
+    slack = 4. * np.finfo(d.dtype).eps * a.shape[1]
+    d -= (anorms[:,np.newaxis] + bnorms) * slack
+    d[np.where(d<0)] = 0
+    return np.sqrt(d)
+
+
+# registry, name -> backend class
+BACKENDS = {}
+for _b in (BruteBackend,CKDTreeBackend,AnnBackend,AnnApproxBackend,
+           ElkanBackend,PDSBackend,PCABackend,LSHBackend):
+    BACKENDS[_b.name] = _b
+
+
+def available_backends(exact=True,nCodes=None,approx=False,rerank=False):
+    """
+    Returns the names of the backends whose libraries are installed,
+    only the exact ones unless exact is False.
+    If nCodes is given, skip those too expensive for that codebook size.
+    If approx, only those that use the model approx (kd-trees).
+    If rerank, only those that use the model rerank (brute force).
+    """
+    res = []
+    for name in sorted(BACKENDS.keys()):
+        b = BACKENDS[name]
+        if not b.available or not (b.exact or not exact):
+            continue
+        if approx and not b.approx:
+            continue
+        if rerank and not b.rerank:
+            continue
+        if (nCodes is not None and b.maxCodes is not None and
+            nCodes > b.maxCodes):
+            continue
+        res.append(name)
+    return res
+
+
+def create_backend(name,model):
+    """
+    Creates the backend called 'name' for the given model.
+    """
+    assert BACKENDS.has_key(name),'unknown search backend: %s.'%name
+    assert BACKENDS[name].available,('search backend %s not available,'
+                                     ' missing library?'%name)
+    return BACKENDS[name](model)
+
+
+def calibrate(model,nFeats,lrate=0.,candidates=None,nCycles=3,maxFeats=1000):
+    """
+    Times the candidate backends (default: every exact available one,
+    kd-trees only if the model has approx > 0, brute force only if
+    it has rerank > 1) on a scratch copy of the model, with fake
+    patterns (random codes plus noise) in batches of nFeats, like
+    the real ones.
+    A cycle is what an update does: search the patterns and, if
+    lrate > 0, move the codes (so dynamic backends pay codes_moved()).
+    Static backends are also charged their build time at the rate
+    they are rebuilt: every time indexmaxdirty of the codes moved,
+    given how many codes a batch moves.
+    Batches are capped at maxFeats, time is then scaled up.
+    Returns the name of the fastest backend.
+    """
+    if candidates is None:
+        candidates = available_backends(nCodes=model._nCodes,
+                                        approx=model._approx > 0,
+                                        rerank=model._rerank > 1)
+    assert len(candidates) > 0,'no search backend available'
+    if len(candidates) == 1:
+        return candidates[0]
+    # fake patterns
+    codebook = model._codebook
+    n = max(1,min(nFeats,maxFeats))
+    feats = codebook[np.random.randint(codebook.shape[0],size=n)]
+    feats = feats + np.random.randn(*feats.shape) * codebook.std() * .1
+    feats = feats.astype(codebook.dtype)
+    # time every backend
+    best_name = None
+    best_time = np.inf
+    for name in candidates:
+        scratch = model._scratch_copy()
+        scratch.set_backend(name)
+        tstart = time.time()
+        backend = scratch._get_backend(n)
+        buildtime = time.time() - tstart
+        cycletime = 0.
+        nMoved = 0
+        for cycle in range(nCycles):
+            tstart = time.time()
+            codes,dists = scratch.predicts(feats)
+            if lrate > 0:
+                scratch._update_codes(feats,codes,lrate)
+                nMoved += len(np.unique(codes))
+            cycletime += time.time() - tstart
+            # rebuilt during the cycle, charged below
+            if scratch._backend is not backend:
+                cycletime -= buildtime
+                backend = scratch._backend
+        t = cycletime / nCycles * nFeats / n
+        if backend.static and nMoved > 0:
+            movedPerUpdate = min(model._nCodes,
+                                 nMoved * 1. / nCycles * nFeats / n)
+            updatesPerBuild = max(1.,model._indexmaxdirty * model._nCodes
+                                  / movedPerUpdate)
+            t += buildtime / updatesPerBuild
+        if t < best_time:
+            best_time = t
+            best_name = name
+    return best_name
@@ -42,10 +42,12 @@ def safe_traceback(folder):
         return [None]
         
 
-def test_saved_model_folder(dirname,feats,output):
+def test_saved_model_folder(dirname,feats,output,nProcs=1):
     """
     Test a saved model by loading it and applying to features.
     Output is the output file, used with print_write()
+    nProcs > 1 shares the prediction between that many processes,
+    see model.predicts_parallel()
     RETURN
       avgerage dist
       nPatterns
@@ -62,12 +64,47 @@ def test_saved_model_folder(dirname,feats,output):
     print_write('nPatterns: '+str(nPatterns),output)
     print_write('total time ran: '+str(totalTime),output)
     # predict
-    best_code_per_p, dists = model.predicts(feats)
+    if nProcs > 1:
+        best_code_per_p, dists = MODEL.predicts_parallel(model,feats,nProcs=nProcs)
+    else:
+        best_code_per_p, dists = model.predicts(feats)
     print_write('prediction done, avg. dist: '+str(np.average(dists)),output)
     # return
     return np.average(dists),nPatterns,nIters,totalTime
 
 
+def test_saved_model_folder_stream(dirname,params,matfilesdir,output):
+    """
+    Same as test_saved_model_folder() but the features are read and
+    predicted one track at a time, see model.predicts_stream().
+    Params are used to create the oracle on matfilesdir.
+    RETURN
+      avgerage dist
+      nPatterns
+      nIters
+      totaltime
+    """
+    print_write('*** MODEL SAVED IN: '+dirname+' ***',output)
+    # load model
+    model = ANALYZE.unpickle(os.path.join(dirname,'model.p'))
+    print_write('model loaded',output)
+    # find nIters (#tracks), nPatterns, totaltime
+    nIters, nPatterns, totalTime = ANALYZE.traceback_stats(dirname)
+    print_write('nIters (=nTracks): '+str(nIters),output)
+    print_write('nPatterns: '+str(nPatterns),output)
+    print_write('total time ran: '+str(totalTime),output)
+    # predict
+    oracle = ORACLE.OracleMatfiles(params,matfilesdir,oneFullIter=True)
+    stats = MODEL.PredictStats()
+    for codes,dists in MODEL.predicts_stream(model,oracle,stats=stats):
+        pass
+    print_write('prediction done on '+str(stats.nPatterns)+' patterns, '+
+                str(stats.nCodesUsed())+' codes used',output)
+    print_write('prediction done, avg. dist: '+str(stats.avg_dist()),output)
+    # return
+    return stats.avg_dist(),nPatterns,nIters,totalTime
+
+
 
 def die_with_usage():
     """
@@ -83,6 +120,8 @@ def die_with_usage():
     print 'FLAGS:'
     print '  -testone       test only the given saved model'
     print '  -plot          plot dist in function of patterns seen'
+    print '  -nProcs n      predict with n processes'
+    print '  -stream        read and predict one track at a time (low memory)'
     print ''
     print 'T. Bertin-Mahieux (2010) Columbia University'
     print 'tb2332@columbia.edu'
@@ -98,11 +137,18 @@ if __name__ == '__main__':
     # flags
     doplot = False
     testone = False
+    nProcs = 1
+    stream = False
     while True:
         if sys.argv[1] == '-testone':
             testone = True
         elif sys.argv[1] == '-plot':
             doplot = True
+        elif sys.argv[1] == '-nProcs':
+            nProcs = int(sys.argv[2])
+            sys.argv.pop(1)
+        elif sys.argv[1] == '-stream':
+            stream = True
         else:
             break
         sys.argv.pop(1)
@@ -164,23 +210,24 @@ if __name__ == '__main__':
     print_write('PARAMS:',output)
     for k in params.keys():
         print_write(str(k)+' : '+str(params[k]),output)
-    # load data into memory
-    oracle = ORACLE.OracleMatfiles(params,matfilesdir,oneFullIter=True)
-    # get all features
-    data = [x for x in oracle]
-    print_write('retrieved '+str(len(data))+' tracks.',output)
-    # get none none features
-    data = filter(lambda x: x != None, data)
-    print_write(str(len(data))+' tracks not None remaining.',output)
-    # transform into numpy array
-    data = np.concatenate(data)
-    print_write(str(data.shape[0])+' patterns loaded.',output)
-    # remove empty patterns
-    data = data[np.where(np.sum(data,axis=1)>0)]
-    print_write(str(data.shape[0])+' non-zero patterns loaded.',output)
-    if data.shape[0] == 0:
-        print_write('No patterns loaded, quit.',output)
-        sys.exit(0)
+    # load data into memory, unless we stream it
+    if not stream:
+        oracle = ORACLE.OracleMatfiles(params,matfilesdir,oneFullIter=True)
+        # get all features
+        data = [x for x in oracle]
+        print_write('retrieved '+str(len(data))+' tracks.',output)
+        # get none none features
+        data = filter(lambda x: x != None, data)
+        print_write(str(len(data))+' tracks not None remaining.',output)
+        # transform into numpy array
+        data = np.concatenate(data)
+        print_write(str(data.shape[0])+' patterns loaded.',output)
+        # remove empty patterns
+        data = data[np.where(np.sum(data,axis=1)>0)]
+        print_write(str(data.shape[0])+' non-zero patterns loaded.',output)
+        if data.shape[0] == 0:
+            print_write('No patterns loaded, quit.',output)
+            sys.exit(0)
 
 
     #******************************************************************
@@ -188,12 +235,16 @@ if __name__ == '__main__':
     dists = []
     patterns = []
     for f in all_to_test:
-        a,b,c,d = test_saved_model_folder(f,data,output)
+        if stream:
+            a,b,c,d = test_saved_model_folder_stream(f,params,matfilesdir,output)
+        else:
+            a,b,c,d = test_saved_model_folder(f,data,output,nProcs=nProcs)
         dist,nPatterns,nIters,totalTime = a,b,c,d
         dists.append(dist)
         patterns.append(nPatterns)
     # in case we plot or something else, release memory
-    del data
+    if not stream:
+        del data
 
     # best result
     smallest_dist_idx = np.argmin(np.array(dists))
@@ -13,6 +13,7 @@ import time
 import copy
 import pickle
 import traceback
+import multiprocessing
 import numpy as np
 import scipy as sp
 import scipy.io
@@ -34,7 +35,10 @@ import analyze_saved_model as ANALYZE
 def train(savedmodel, expdir='', pSize=8, usebars=2, keyInv=True,
           songKeyInv=False, positive=True, do_resample=True, partialbar=0,
           lrate=1e-5, nThreads=4, oracle='EN', artistsdb='', matdir='',
-          nIterations=1e7, useModel='VQ', autobar=False, randoffset=False):
+          nIterations=1e7, useModel='VQ', autobar=False, randoffset=False,
+          updatemode='sequential', backend='auto', nSubCodebooks=2,
+          precision='float64', rerank=0, branching=2, growevery=None,
+          nProcs=1, server=None, approx=0., rotinv=False, authkey=None):
     """
     Performs training
     Grab track data from oracle
@@ -56,7 +60,36 @@ def train(savedmodel, expdir='', pSize=8, usebars=2, keyInv=True,
       artistdb      - SQLlite database containing artist names
       matdir        - matfiles directory, for oracle MAT
       nIterations   - maximum number of iterations
-      useModel      - which model to use: 'VQ', 'VQFILT'
+      useModel      - which model to use: 'VQ', 'VQFILT', 'PQ', 'TSVQ', 'RVQ'
+      autobar       - self-adjusting bar offset, only matfiles oracle
+      randoffset    - random offset (0 to 3) for each track
+      updatemode    - 'sequential' or 'minibatch', how codes hit
+                      many times in a track are moved
+      backend       - search backend name, or 'auto' to pick the fastest
+                      on this machine, see search_backends.py
+                      (not taken from a saved model, machine dependent)
+      nSubCodebooks - for 'PQ', number of blocks of beats, must divide
+                      pSize (or partialbar); for 'RVQ', number of stages
+      precision     - 'float64' or 'float32', for features, distances
+                      and codebook
+      rerank        - if > 1, brute force search in float32 re-ranks
+                      that many best codes in float64
+      branching     - for 'TSVQ', number of children per node
+      growevery     - for 'TSVQ', add a level to the tree every that many
+                      patterns, None to train the full tree from the start
+      approx        - eps for approximate kd-tree search (VQ, VQFILT),
+                      recall is measured and printed
+      rotinv        - match patterns over their 12 chroma rotations
+                      (VQ, VQFILT), see Model.predicts_rotinv()
+      nProcs        - if > 1, number of worker processes updating a shared
+                      codebook without locks, see hogwild_training()
+                      (not taken from a saved model, machine dependent)
+      server        - 'host:port', run as a parameter server, workers on
+                      other machines send their updates, see param_server.py
+                      nProcs > 1 then starts that many workers on localhost
+                      (not taken from a saved model, machine dependent)
+      authkey       - secret key shared with the workers, default: the
+                      environment variable ONLINE_VQ_AUTHKEY (never saved)
 
     Saves everything when done.
     """
@@ -87,22 +120,40 @@ def train(savedmodel, expdir='', pSize=8, usebars=2, keyInv=True,
         oldparams = param_unp.load()
         f.close()
         for k in oldparams.keys():
-            if k == 'savedmodel': # special case
+            if k in ('savedmodel','backend','nProcs','server'): # special cases
                 continue
             exec_str = k + ' = oldparams["'+k+'"]'
             exec( exec_str )
             print 'from saved model,',k,'=',eval(k)
         # get global_iterations
         global_iterations,tmp1,tmp2 = ANALYZE.traceback_stats(savedmodel)
+        # search backend is chosen for this run
+        if hasattr(model,'set_backend'):
+            model.set_backend(backend)
         
     # initialized model from codebook
     elif os.path.isfile(savedmodel):
         codebook = load_codebook(savedmodel)
         assert codebook != None,'Could not load codebook in: %s.'%savedmodel
+        codebook = codebook.astype(precision)
         if useModel == 'VQ':
-            model = MODEL.Model(codebook)
+            model = MODEL.Model(codebook,updatemode=updatemode,
+                                backend=backend,rerank=rerank,
+                                approx=approx,rotinv=rotinv)
         elif useModel == 'VQFILT':
-            model = MODEL.ModelFilter(codebook)
+            model = MODEL.ModelFilter(codebook,updatemode=updatemode,
+                                      backend=backend,rerank=rerank,
+                                      approx=approx,rotinv=rotinv)
+        elif useModel == 'PQ':
+            model = MODEL.ModelPQ(codebook,nSubspaces=nSubCodebooks,
+                                  updatemode=updatemode)
+        elif useModel == 'RVQ':
+            model = MODEL.ModelRVQ(codebook,nStages=nSubCodebooks,
+                                   updatemode=updatemode)
+        elif useModel == 'TSVQ':
+            model = MODEL.ModelTree(codebook,branching=branching,
+                                    updatemode=updatemode,
+                                    growevery=growevery)
         else:
             assert False, 'wrong model codename: %s.'%useModel
         statlog.startFromScratch()
@@ -119,22 +170,36 @@ def train(savedmodel, expdir='', pSize=8, usebars=2, keyInv=True,
               'nThreads':nThreads, 'oracle':oracle,
               'artistsdb':artistsdb, 'matdir':matdir,
               'nIterations':nIterations, 'useModel':useModel,
-              'autobar':autobar,'randoffset':randoffset}
+              'autobar':autobar,'randoffset':randoffset,
+              'updatemode':updatemode, 'backend':backend,
+              'nSubCodebooks':nSubCodebooks, 'precision':precision,
+              'rerank':rerank, 'branching':branching,
+              'growevery':growevery, 'nProcs':nProcs, 'server':server,
+              'approx':approx, 'rotinv':rotinv}
 
     # creates the experiment folder
     if not os.path.isdir(expdir):
         print 'creating experiment directory:',expdir
         os.mkdir(expdir)
 
-    # create oracle
+    # multiple processes, each creates its own oracle
     if autobar:
         assert oracle=='MAT','autobar implemented only for matfiles oracle'
-    if oracle == 'EN':
-        oracle = oracle_en.OracleEN(params,artistsdb)
-    elif oracle == 'MAT':
-        oracle = oracle_matfiles.OracleMatfiles(params,matdir)
-    else:
-        assert False, 'wrong oracle codename: %s.'%oracle
+    if server is not None:
+        import param_server
+        authkey = param_server.get_authkey(authkey)
+        nLocalWorkers = 0
+        if nProcs > 1:
+            nLocalWorkers = nProcs
+        return param_server.serve(model,params,expdir,statlog,
+                                  global_iterations,server,authkey,
+                                  nLocalWorkers=nLocalWorkers)
+    if nProcs > 1:
+        return hogwild_training(model,params,expdir,statlog,
+                                global_iterations,nProcs)
+
+    # create oracle
+    oracle = create_oracle(params)
 
     # starttime and save time
     starttime = time.time()
@@ -152,6 +217,9 @@ def train(savedmodel, expdir='', pSize=8, usebars=2, keyInv=True,
             global_iterations += 1
             if main_iterations == int(np.ceil(last_printed_iter * 1.1)) and len(dist_estimate) > 0:
                 print main_iterations,'/',global_iterations,'iterations (local/global), approx. avg dist:',np.average(dist_estimate)
+                if hasattr(model,'approx_report') and model._approx > 0:
+                    recall,excess = model.approx_report()
+                    print 'approximate search, recall:',recall,'excess dist:',excess
                 last_printed_iter = main_iterations
             statlog.iteration()
             if global_iterations > nIterations:
@@ -217,6 +285,209 @@ def train(savedmodel, expdir='', pSize=8, usebars=2, keyInv=True,
 
 
 
+def create_oracle(params):
+    """
+    Creates the oracle given by params['oracle'], EN (EchoNest)
+    or MAT (matfiles).
+    """
+    oracle = params['oracle']
+    if oracle == 'EN':
+        return oracle_en.OracleEN(params,params['artistsdb'])
+    elif oracle == 'MAT':
+        return oracle_matfiles.OracleMatfiles(params,params['matdir'])
+    else:
+        assert False, 'wrong oracle codename: %s.'%oracle
+
+
+def share_codebook(model):
+    """
+    Moves the codebook of the model (and the inner levels of a tree)
+    into shared memory, processes forked after that all update the
+    same codebook. Works for every model, the codebook is replaced
+    by a numpy view of the shared buffer.
+    """
+    def to_shared(a):
+        typecode = {'float64':'d','float32':'f'}[str(a.dtype)]
+        buf = multiprocessing.RawArray(typecode,a.size)
+        shared = np.frombuffer(buf,dtype=a.dtype).reshape(a.shape)
+        shared[:] = a
+        return shared
+    model._codebook = to_shared(model._codebook)
+    if hasattr(model,'_levels'):
+        model._levels = [to_shared(l) for l in model._levels]
+
+
+def forget_search_caches(model):
+    """
+    Other processes move the shared codes, forget the norms and
+    search index computed on the old ones.
+    """
+    if hasattr(model,'_reset_search_caches'):
+        model._reset_search_caches()
+    else:
+        model._set_default_attributes()
+
+
+def set_worker_backend(model):
+    """
+    Search backend of a worker whose codebook is moved by others:
+    brute force, it follows the codebook, nothing to rebuild.
+    The search is exact (approx = 0) in the workers, a kd-tree would
+    be rebuilt for every track: the caches are forgotten each time,
+    see forget_search_caches().
+    """
+    if not hasattr(model,'set_backend'):
+        return
+    model._approx = 0.
+    model.set_backend('brute')
+
+
+def hogwild_worker(model,params,counters,maxIterations,stop,activeDepth):
+    """
+    Training loop of a process in hogwild_training(): get a track,
+    update the shared codebook, no lock.
+    counters = (iterations, patterns) shared between processes, we
+    stop after maxIterations (all processes together) or when the
+    Event stop is set by the coordinator.
+    activeDepth: shared active depth of a growing ModelTree, the
+    coordinator grows the tree, see hogwild_grow().
+    """
+    # forked processes get the same random state
+    np.random.seed((os.getpid() * 1000003 + int(time.time())) % 4294967296)
+    set_worker_backend(model)
+    growing = getattr(model,'_growevery',None) is not None
+    if growing:
+        model._growevery = None
+    oracle = create_oracle(params)
+    nIterations,nPatterns = counters
+    lrate = params['lrate']
+    try:
+        while not stop.is_set():
+            nIterations.acquire()
+            nIterations.value += 1
+            done = nIterations.value > maxIterations
+            nIterations.release()
+            if done:
+                break
+            if not params['autobar']:
+                feats = oracle.next_track()
+            else:
+                feats = oracle.next_track(auto_bar=model)
+            if feats == None:
+                continue
+            feats = feats[np.nonzero(np.sum(feats,axis=1))]
+            if feats.shape[0] == 0:
+                continue
+            assert not np.isnan(feats).any(),'features have NaN???'
+            nPatterns.acquire()
+            nPatterns.value += feats.shape[0]
+            nPatterns.release()
+            forget_search_caches(model)
+            if growing:
+                model._activeDepth = activeDepth.value
+            avg_dist = model.update(feats,lrate=lrate)
+            assert not np.isnan(avg_dist)
+    except KeyboardInterrupt:
+        pass
+    except:
+        print 'worker',os.getpid(),'crashed:'
+        traceback.print_exc()
+    # EN oracle, try to stop/slow down threads
+    try:
+        oracle_en._en_queue_size = 0
+    except NameError:
+        pass
+
+
+def hogwild_grow(model,nPatternsSeen,activeDepth):
+    """
+    Growth of a ModelTree trained by hogwild workers, done by the
+    coordinator: the workers all update the shared levels, but the
+    growth schedule must count the patterns of all of them, and the
+    saved model must have the right depth.
+    nPatternsSeen: patterns used by all the workers, since the start
+    activeDepth: shared value read by the workers before every track
+    """
+    if getattr(model,'_growevery',None) is None:
+        return
+    model._nPatternsSeen = nPatternsSeen
+    model.grow_on_schedule()
+    activeDepth.value = model._activeDepth
+
+
+def hogwild_training(model,params,expdir,statlog,global_iterations,nProcs):
+    """
+    Training with nProcs worker processes (Hogwild: Recht et al. 2011).
+    The codebook is in shared memory, each worker gets tracks from its
+    own oracle and updates it without locks, collisions are rare with
+    small learning rates. The workers search by brute force, their
+    search caches are reset before every update.
+    This process only saves the experiment, with the StatLog counters
+    of all the workers, as in train(). Model statistics that are not
+    in the codebook (e.g. ModelFilter distances) stay in the workers,
+    except the growth of a ModelTree, see hogwild_grow().
+    Returns the exit code, as train().
+    """
+    share_codebook(model)
+    # counters are updated once per track, a lock is cheap
+    iterations = multiprocessing.Value('l',0)
+    patterns = multiprocessing.Value('l',0)
+    activeDepth = multiprocessing.Value('l',getattr(model,'_activeDepth',0))
+    nSeenStart = getattr(model,'_nPatternsSeen',0)
+    maxIterations = params['nIterations'] - global_iterations
+    stop = multiprocessing.Event()
+    workers = []
+    for k in range(nProcs):
+        p = multiprocessing.Process(target=hogwild_worker,
+                                    args=(model,params,(iterations,patterns),
+                                          maxIterations,stop,activeDepth))
+        p.start()
+        workers.append(p)
+    print 'launched',nProcs,'workers'
+    # starttime and save time
+    starttime = time.time()
+    last_save = starttime
+    nIterStart = statlog.nIterations
+    nPatternStart = statlog.nPatternUsed
+    last_printed_iter = 1
+    exit_code = 1
+    try:
+        try:
+            while True:
+                time.sleep(1)
+                statlog.nIterations = nIterStart + iterations.value
+                statlog.nPatternUsed = nPatternStart + patterns.value
+                hogwild_grow(model,nSeenStart + patterns.value,activeDepth)
+                if iterations.value >= int(np.ceil(last_printed_iter * 1.1)):
+                    print iterations.value,'/',global_iterations + iterations.value,'iterations (local/global),',patterns.value,'patterns'
+                    last_printed_iter = iterations.value
+                if not np.any([p.is_alive() for p in workers]):
+                    if iterations.value > maxIterations:
+                        exit_code = 0 # normal exit
+                    else:
+                        print 'all workers stopped'
+                    break
+                if should_save(starttime,last_save):
+                    savedir = save_experiment(expdir,model,starttime,statlog,params)
+                    last_save = time.time()
+        except KeyboardInterrupt:
+            print ''
+            print 'Stoping after', iterations.value, 'iterations.'
+    finally:
+        stop.set()
+        for p in workers:
+            p.join()
+    statlog.nIterations = nIterStart + min(iterations.value,maxIterations)
+    statlog.nPatternUsed = nPatternStart + patterns.value
+    hogwild_grow(model,nSeenStart + patterns.value,activeDepth)
+    # save
+    print 'saving...'
+    savedir = save_experiment(expdir,model,starttime,statlog,params,
+                              crash=True)
+    print 'saved to: ',savedir
+    return exit_code
+
+
 class StatLog:
     """
     Simple class to keep track of different stats of the trainer
@@ -296,6 +567,9 @@ def save_experiment(expdir,model,starttime,statlog,params,crash=False):
     """
     savedir = get_savedir_name(expdir)
     os.mkdir(savedir)
+    # consistent version of the model, training can go on
+    if hasattr(model,'snapshot'):
+        model = model.snapshot()
     # save codebook as matfile
     if hasattr(model,'_codebook'):
         fname = os.path.join(savedir,'codebook.mat')
@@ -304,15 +578,25 @@ def save_experiment(expdir,model,starttime,statlog,params,crash=False):
     f = open(os.path.join(savedir,'model.p'),'w')
     pickle.dump(model,f)
     f.close()
-    # save model without numpy
+    # save model without numpy, shallow copy without the codebook
     #model2 = copy.deepcopy(model) # causes problem, no idea why
-                                   # hack around, keep codebook, remove it, save it, add cb back
-    codebook = model._codebook
-    model._codebook = None
+    model_nonumpy = copy.copy(model)
+    model_nonumpy._codebook = None
+    # hits per code, rebuilt (zeros) when loaded
+    if hasattr(model_nonumpy,'_code_hits'):
+        del model_nonumpy._code_hits
+    # ring buffers of distances (ModelFilter), as lists
+    if hasattr(model_nonumpy,'_dist_buffer'):
+        model_nonumpy._dist_buffer = model._dist_buffer.tolist()
+        model_nonumpy._dist_sum = model._dist_sum.tolist()
+        model_nonumpy._dist_count = model._dist_count.tolist()
+        model_nonumpy._dist_pos = model._dist_pos.tolist()
+    # inner levels of a tree (ModelTree), as lists
+    if hasattr(model_nonumpy,'_levels'):
+        model_nonumpy._levels = [l.tolist() for l in model._levels]
     f = open(os.path.join(savedir,'model_nonumpy.p'),'w')
-    pickle.dump(model,f)
+    pickle.dump(model_nonumpy,f)
     f.close()
-    model._codebook = codebook
     # save stats
     f = open(os.path.join(savedir,'stats.p'),'w')
     pickle.dump(statlog,f)
@@ -382,9 +666,26 @@ def die_with_usage():
     print '                   used by EchoNest oracle'
     print ' -oraclemat d      matfiles oracle, d: matfiles dir'
     print ' -nIters n         maximum number of iterations'
-    print ' -useModel N       model name, VQ (default), VQFILT'
+    print ' -useModel N       model name, VQ (default), VQFILT, PQ, TSVQ, RVQ'
     print ' -autobar          trains with self-adjusting bar offset, only matfiles oracle'
     print ' -randoffset       uses a random offset for each track ranging from 0 to 3 inclusive'
+    print ' -updatemode m     sequential (default) or minibatch codebook update'
+    print ' -backend b        search backend: brute, ckdtree, ann, ann_approx, elkan,'
+    print '                   pds, pca, lsh (approximate)'
+    print '                   or auto (default, fastest on this machine)'
+    print ' -nSubCB n         number of sub codebooks: blocks of beats for PQ,'
+    print '                   stages for RVQ'
+    print ' -branching n      number of children per node for TSVQ'
+    print ' -growevery n      for TSVQ, add a tree level every n patterns'
+    print ' -float32          features, distances and codebook in single precision'
+    print ' -rerank n         with -float32, re-rank n best codes in double precision'
+    print ' -approx eps       approximate kd-tree search, recall is measured'
+    print ' -rotinv           match patterns over the 12 chroma rotations'
+    print ' -nProcs n         train with n processes sharing the codebook'
+    print ' -server host:port parameter server for workers on other machines,'
+    print '                   see param_server.py, -nProcs n adds n local workers'
+    print ' -authkey k        secret key for -server, default: environment'
+    print '                   variable ONLINE_VQ_AUTHKEY (no default key)'
     print ' -profile f        use profiler, output to f, limits iters to 100'
     print ''
     print 'typical command to initialize from codebook:'
@@ -419,6 +720,18 @@ if __name__ == '__main__':
     useModel = 'VQ'
     autobar = False
     randoffset = False
+    updatemode = 'sequential'
+    backend = 'auto'
+    nSubCodebooks = 2
+    branching = 2
+    growevery = None
+    nProcs = 1
+    server = None
+    authkey = None
+    approx = 0.
+    rotinv = False
+    precision = 'float64'
+    rerank = 0
     profile = ''
     while True:
         if sys.argv[1] == '-expdir':
@@ -480,6 +793,51 @@ if __name__ == '__main__':
         elif sys.argv[1] == '-randoffset':
             randoffset = True
             print 'randoffset =', randoffset
+        elif sys.argv[1] == '-updatemode':
+            updatemode = sys.argv[2]
+            sys.argv.pop(1)
+            print 'updatemode =', updatemode
+        elif sys.argv[1] == '-backend':
+            backend = sys.argv[2]
+            sys.argv.pop(1)
+            print 'backend =', backend
+        elif sys.argv[1] == '-nSubCB':
+            nSubCodebooks = int(sys.argv[2])
+            sys.argv.pop(1)
+            print 'nSubCodebooks =', nSubCodebooks
+        elif sys.argv[1] == '-branching':
+            branching = int(sys.argv[2])
+            sys.argv.pop(1)
+            print 'branching =', branching
+        elif sys.argv[1] == '-nProcs':
+            nProcs = int(sys.argv[2])
+            sys.argv.pop(1)
+            print 'nProcs =', nProcs
+        elif sys.argv[1] == '-rotinv':
+            rotinv = True
+            print 'rotinv =', rotinv
+        elif sys.argv[1] == '-approx':
+            approx = float(sys.argv[2])
+            sys.argv.pop(1)
+            print 'approx =', approx
+        elif sys.argv[1] == '-server':
+            server = sys.argv[2]
+            sys.argv.pop(1)
+            print 'server =', server
+        elif sys.argv[1] == '-authkey':
+            authkey = sys.argv[2]
+            sys.argv.pop(1)
+        elif sys.argv[1] == '-growevery':
+            growevery = int(sys.argv[2])
+            sys.argv.pop(1)
+            print 'growevery =', growevery
+        elif sys.argv[1] == '-float32':
+            precision = 'float32'
+            print 'precision =', precision
+        elif sys.argv[1] == '-rerank':
+            rerank = int(sys.argv[2])
+            sys.argv.pop(1)
+            print 'rerank =', rerank
         elif sys.argv[1] == '-profile':
             profile = sys.argv[2]
             nIterations = 100
@@ -504,12 +862,16 @@ if __name__ == '__main__':
               do_resample=do_resample, partialbar=partialbar, lrate=lrate,
               nThreads=nThreads, oracle=oracle, artistsdb=artistsdb,
               matdir=matdir, nIterations=nIterations, useModel=useModel,
-              autobar=autobar, randoffset=randoffset)
+              autobar=autobar, randoffset=randoffset, updatemode=updatemode,
+              backend=backend, nSubCodebooks=nSubCodebooks,
+              precision=precision, rerank=rerank, branching=branching,
+              growevery=growevery, nProcs=nProcs, server=server,
+              approx=approx, rotinv=rotinv, authkey=authkey)
 
     else:
         import cProfile
         cProfile.run(\
-            'train(savedmodel, expdir=expdir, pSize=pSize,usebars=usebars, keyInv=keyInv,songKeyInv=songKeyInv, positive=positive, do_resample=do_resample, partialbar=partialbar, lrate=lrate, nThreads=nThreads, oracle=oracle, artistsdb=artistsdb, matdir=matdir, nIterations=nIterations, useModel=useModel, autobar=autobar,randoffset=randoffset)',
+            'train(savedmodel, expdir=expdir, pSize=pSize,usebars=usebars, keyInv=keyInv,songKeyInv=songKeyInv, positive=positive, do_resample=do_resample, partialbar=partialbar, lrate=lrate, nThreads=nThreads, oracle=oracle, artistsdb=artistsdb, matdir=matdir, nIterations=nIterations, useModel=useModel, autobar=autobar,randoffset=randoffset, updatemode=updatemode, backend=backend, nSubCodebooks=nSubCodebooks, precision=precision, rerank=rerank, branching=branching, growevery=growevery, nProcs=nProcs, server=server, approx=approx, rotinv=rotinv, authkey=authkey)',
             filename=profile)
         # load and print stats
         stats = pstats.Stats(profile)